@@ -17,24 +17,154 @@ import io                   # io operations
 import sys                  # system operations
 import re                   # regular expressions
 import json                 # json load and dump
+import time                 # time utilities
 import datetime             # date and time utilities
+import hashlib              # template hashes
+from email.utils import formatdate, parsedate_to_datetime    # http dates
 
 # special libraries
 import boto3                # AWS services
 from chalicelib import process
 
 # setup chalice
-from chalice import Chalice, Response           # python serverless engine
+from chalice import Chalice, Response, BadRequestError, Rate    # python serverless engine
 app = Chalice(app_name='pinterest_chalice')     # create app, empower decorators
 app.debug = True
 
 # setup jinja2 templates
-from jinja2 import Environment, FileSystemLoader
+# precompiled template modules (see build_templates.py) are used when they are bundled
+# and the manifest build_templates.py wrote says they were built from these sources
+from jinja2 import Environment, FileSystemLoader, ModuleLoader, ChoiceLoader
 template_dir = os.path.join(os.path.dirname(__file__), 'chalicelib', 'templates')
-j2_env = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True)
+compiled_dir = os.path.join(os.path.dirname(__file__), 'chalicelib', 'templates_compiled')
+manifest_name = 'manifest.json'
+template_options = {'trim_blocks': True}
+
+
+# ------------------------------------------------------------------------------
+def template_hashes():
+    """ md5 of every template source, by template name
+    """
+    hashes = {}
+    for name in sorted(os.listdir(template_dir)):
+        if not name.endswith('.html'): continue
+        with open(os.path.join(template_dir, name), 'rb') as f: hashes[name] = hashlib.md5(f.read()).hexdigest()
+
+    return hashes
+
+
+# ------------------------------------------------------------------------------
+def compiled_current():
+    """ true when the compiled templates were built from the current sources
+    """
+    try:
+        with open(os.path.join(compiled_dir, manifest_name)) as f: manifest = json.load(f)
+    except (IOError, ValueError):
+        return False
+
+    return manifest == template_hashes()
+
+
+loaders = [FileSystemLoader(template_dir)]
+if os.path.isdir(compiled_dir):
+    if compiled_current(): loaders.insert(0, ModuleLoader(compiled_dir))
+    else: print('compiled templates are stale, run build_templates.py, using the sources')
+j2_env = Environment(loader=ChoiceLoader(loaders), auto_reload=False, **template_options)
+
+# preload every template at container start
+templates = dict((name, j2_env.get_template(name))
+                 for name in sorted(os.listdir(template_dir)) if name.endswith('.html'))
+
+# reflect the tables at container start rather than on the first requests, under
+# lambda only since packaging imports this module without a database
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    try: process.reflect_tables()
+    except Exception: print('table reflection failed, tables are reflected on first use')
 
 # sign on
 print('Pinterest')
+print('import timing {}'.format(process.import_timing))
+
+
+# ------------------------------------------------------------------------------
+@app.middleware('all')
+def trace_request(event, get_response):
+    """ when tracing is on (process.set_tracing), times the request or event
+        and logs its spans as one json record
+    """
+    if not process.trace_enabled: return get_response(event)
+
+    process.start_trace(getattr(event, 'path', None) or type(event).__name__, method=getattr(event, 'method', None))
+    status = None
+    try:
+        response = get_response(event)
+        status = getattr(response, 'status_code', None)
+        return response
+    finally:
+        process.end_trace(status=status)
+
+
+# ------------------------------------------------------------------------------
+@app.middleware('all')
+def flush_takedowns(event, get_response):
+    """ after the request, purges the takedowns that came due since the
+        last decision, see process.purge_takedowns. flush_purges logs its
+        errors, a failing purge does not fail the request.
+    """
+    response = get_response(event)
+    process.flush_purges()
+
+    return response
+
+
+# ------------------------------------------------------------------------------
+def render(t, **context):
+    """ renders a template, as a span of the request trace when tracing is on
+        in: jinja2 template, template variables
+        return html
+    """
+    if not process.trace_enabled: return t.render(**context)
+
+    start = time.time()
+    html = t.render(**context)
+    process.trace_span('render', t.name, time.time() - start, start)
+
+    return html
+
+
+# ------------------------------------------------------------------------------
+def get_paging(request):
+    """ reads the cursor and limit query parameters of a paginated page
+        in: chalice request
+        return cursor, limit
+    """
+    params = request.query_params or {}
+    try:
+        cursor = int(params['cursor']) if params.get('cursor') else None
+        limit = int(params.get('limit', process.page_limit))
+    except ValueError:
+        raise BadRequestError("cursor and limit must be integers")
+
+    return cursor, max(1, min(limit, process.page_limit_max))
+
+
+# ------------------------------------------------------------------------------
+def not_modified(request, etag, modified):
+    """ checks the conditional request headers against a cached page
+        in: chalice request, page etag, page modified time (epoch seconds)
+        return True when the browser's copy is current
+    """
+    headers = request.headers or {}
+    if headers.get('if-none-match'):
+        tags = [tag.strip() for tag in headers['if-none-match'].split(',')]
+        return etag in tags or '*' in tags
+
+    if headers.get('if-modified-since'):
+        try: since = parsedate_to_datetime(headers['if-modified-since']).timestamp()
+        except (TypeError, ValueError): return False
+        return int(modified) <= since
+
+    return False
 
 
 # ------------------------------------------------------------------------------
@@ -43,9 +173,9 @@ def index():
     """ splash page
     """
     mydict = {}
-    t = j2_env.get_template('index.html')
+    t = templates['index.html']
 
-    return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+    return Response(body=render(t, my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
 
 
 # ------------------------------------------------------------------------------
@@ -54,30 +184,39 @@ def index():
     """ splash page
     """
     mydict = {}
-    t = j2_env.get_template('index.html')
+    t = templates['index.html']
 
-    return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+    return Response(body=render(t, my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
 
 
 # ------------------------------------------------------------------------------
 @app.route('/pinner', methods=['GET'])
 def pinner_call():
-    """ pinner page with all the selectable content
+    """ pinner page with all the selectable content, served from the gallery
+        page cache, 304 when the browser already has this page
     """
-    contents = process.get_content_list()
-    mydict = {}
-    for c in contents:
-        if c['display_status'] == 'good':
-            mydict['cid' + str(c['content_id'])] = str(c['content_id'])
-            mydict['url' + str(c['content_id'])] = c['url']
-        else:
-            mydict['cid' + str(c['content_id'])] = None
-            mydict['url' + str(c['content_id'])] = ""
-            
-    # get template
-    t = j2_env.get_template('pinner.html')
+    request = app.current_request
+    cursor, limit = get_paging(request)
 
-    return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+    def render_page(contents, cursor_next):
+        mydict = {}
+        mydict['contents'] = contents
+        mydict['cursor'] = cursor_next
+        mydict['limit'] = limit
+        t = templates['pinner.html']
+        return render(t, my_dict=mydict)
+
+    page = process.get_gallery_page(cursor, limit, render_page)
+    headers = {
+        'Content-Type': 'text/html',
+        'ETag': page['etag'],
+        'Last-Modified': formatdate(page['modified'], usegmt=True),
+        'Cache-Control': 'no-cache'         # always revalidate, moderation can pull an image
+    }
+    if not_modified(request, page['etag'], page['modified']):
+        return Response(body='', status_code=304, headers=headers)
+
+    return Response(body=page['body'], status_code=200, headers=headers)
 
 
 # ------------------------------------------------------------------------------
@@ -86,28 +225,63 @@ def pinner_cs_call():
     """ pinner content safety complaint page
     """
     request = app.current_request
+    cursor, limit = get_paging(request)
     content = process.get_content(request.query_params['content_id'])
-    pinners = process.get_pinners_list()
-    mydict = content
-    for p in pinners:
-         mydict['pinner' + str(p['pinner_id'])] = str(p['pinner_id'])
-         mydict['email' + str(p['pinner_id'])] = p['email']
+    pinners = process.get_pinners_list(cursor, limit)
+    mydict = content._asdict()
+    mydict['pinners'] = pinners
+    mydict['cursor'] = process.next_cursor(pinners, 'pinner_id', limit)
+    mydict['limit'] = limit
     # get template
-    t = j2_env.get_template('pinner_cs.html')
+    t = templates['pinner_cs.html']
 
-    return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+    return Response(body=render(t, my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
 
 
 # ------------------------------------------------------------------------------
 @app.route('/cs_submit', methods=['GET'])
 def pinner_cs_submit_call():
-    """ pinner submission response page
+    """ pinner submission response page, the complaint is filed at once or,
+        in the queue and wal ingest modes, buffered and filed in a batch
     """
+    start = time.time()
     request = app.current_request
-    complaint_id = process.file_complaint(request.query_params)
-    t = j2_env.get_template('pinner_cs_submit.html')
+    if process.get_ingest_mode() == 'sync':
+        complaint_id = process.file_complaint(request.query_params)
+    else:
+        try: complaint_id = process.ingest_complaint(request.query_params)
+        except ValueError as e: raise BadRequestError(str(e))
+    t = templates['pinner_cs_submit.html']
+
+    response = Response(body=render(t, complaint_id=complaint_id), status_code=200, headers={'Content-Type': 'text/html'})
+    process.record_latency('cs_submit', time.time() - start)
+
+    return response
 
-    return Response(body=t.render(complaint_id=complaint_id), status_code=200, headers={'Content-Type': 'text/html'})
+
+# ------------------------------------------------------------------------------
+def ingest_consumer(event):
+    """ files the complaints buffered in the ingest queue, lambda deletes the
+        messages when this returns and delivers them again if it raises
+    """
+    process.file_complaint_batch([json.loads(record.body) for record in event])
+
+
+# the consumer is only deployed for the queue ingest mode, when CS_INGEST_QUEUE names the queue
+if process.ingest_queue_name:
+    app.on_sqs_message(queue=process.ingest_queue_name, batch_size=10)(ingest_consumer)
+
+
+# ------------------------------------------------------------------------------
+@app.schedule(Rate(15, unit=Rate.MINUTES))
+def reconcile_job(event):
+    """ sends the cdn takedown purges still waiting in pending_purges, first
+        so a reconcile that fails or runs out of time cannot hold them up,
+        then reconciles the review queue with the database, see
+        process.reconcile
+    """
+    process.flush_purges(force=True)
+    process.reconcile(max_seconds=process.reconcile_budget(getattr(event, 'context', None)))
 
 
 # ------------------------------------------------------------------------------
@@ -116,50 +290,60 @@ def reviewer_call():
     """ reviewer page
     """
     mydict = {}
-    t = j2_env.get_template('reviewer.html')
+    t = templates['reviewer.html']
     
-    return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+    return Response(body=render(t, my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
     
     
+# ------------------------------------------------------------------------------
+def review_page(item, reviewer=None):
+    """ renders the page for a review item, or the no complaints page
+        in: review item from process.next_review_item, reviewer email to
+            keep selected
+        return chalice response
+    """
+    if item == None or item == "error":
+        t = templates['re_pop1.html']
+
+        return Response(body=render(t, my_dict={}), status_code=200, headers={'Content-Type': 'text/html'})
+
+    reviewers = process.get_reviewers_list()
+    mydict = item
+    mydict['reviewers'] = reviewers
+    mydict['reviewer'] = reviewer or reviewers[0]['email']
+    t = templates['re_pop2.html']
+
+    return Response(body=render(t, my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+
+
 # ------------------------------------------------------------------------------
 @app.route('/re_pop')
 def reviewer_pop_call():
     """ reviewer image to review page
     """
-    mydict = {}
-    sqsmessage, sqs_id, sqs_handle = process.get_sqsmessage()
-    
-    if sqsmessage == None or sqsmessage == "error":
-        t = j2_env.get_template('re_pop1.html')
-        
-        return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
-        
-    else:
-        content = process.get_content(sqsmessage['content_id'])
-        reviewers = process.get_reviewers_list()
-        
-        for r in reviewers: mydict['email' + str(r['reviewer_id'])] = r['email']
-        mydict['url'] = content['url']
-        mydict['complaint_id'] = sqsmessage['complaint_id']
-        mydict['sqs_handle'] = sqs_handle
-        
-        t = j2_env.get_template('re_pop2.html')
-        
-        return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+    return review_page(process.next_review_item())
 
 
 # ------------------------------------------------------------------------------
 @app.route('/re_submit')
 def reviewer_submit_call():
-    """ reviewer submission page
+    """ reviewer submission page, or with next the following review so a
+        reviewer works through the backlog one request per decision
     """
     request = app.current_request
     success = process.review_complaint(request.query_params)
-    
+
+    if request.query_params.get('next'):
+        return review_page(process.next_review_item(), request.query_params['reviewer'])
+
+    # the reviewer stopped, give the review and the messages this container leased back to the others
+    process.release_prefetch()
+    process.release_sqsbuffer()
+
     mydict = {}
-    t = j2_env.get_template('re_submit.html')
+    t = templates['re_submit.html']
     
-    return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+    return Response(body=render(t, my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
     
 
 # ------------------------------------------------------------------------------
@@ -167,25 +351,19 @@ def reviewer_submit_call():
 def manager_call():
     """ display the complaints data
     """
+    request = app.current_request
+    cursor, limit = get_paging(request)
+    pending = process.get_complaint_list(cursor, limit, process_status='complaint')
+
     mydict = {}
-    comp = []
-    review = []
-    done = []
-    
-    complaints = process.get_complaint_list()
-    for c in complaints:
-        c['complaint_timestamp'] = str(c['complaint_timestamp'])
-        if c['review_timestamp'] != None: c['review_timestamp'] = str(c['review_timestamp'])
-        if c['process_status'] == 'complaint': comp.append(c)
-        elif c['process_status'] == 'review': review.append(c)
-        elif c['process_status'] == 'done': done.append(c)
-    mydict['complaint'] = comp
-    mydict['review'] = review
-    mydict['done'] = done
-
-    t = j2_env.get_template('manager.html')
+    mydict['stats'] = process.get_complaint_stats()
+    mydict['pending'] = pending
+    mydict['cursor'] = process.next_cursor(pending, 'complaint_id', limit)
+    mydict['limit'] = limit
+
+    t = templates['manager.html']
     
-    return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+    return Response(body=render(t, my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
 
 
 # ------------------------------------------------------------------------------
@@ -193,11 +371,11 @@ def manager_call():
 def manager_call():
     """ display the complaints data
     """
-    process.reset_content()
+    counters = process.reset_content()
     
-    mydict = {}
-    t = j2_env.get_template('reset.html')
+    mydict = counters
+    t = templates['reset.html']
     
-    return Response(body=t.render(my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
+    return Response(body=render(t, my_dict=mydict), status_code=200, headers={'Content-Type': 'text/html'})
     
 
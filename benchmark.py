@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+    benchmark.py
+
+    End to end load test of the complaint to takedown pipeline. Builds a
+    fresh database of pinners, contents and reviewers, installs the local
+    sqs stand in, and drives the app routes in process through the chalice
+    test client: pinners browse /pinner, file complaints and complaint
+    storms through /cs_submit, reviewers work the backlog with /re_pop and
+    /re_submit, and managers page through /manager. Reports p50, p95 and
+    p99 latency and throughput for every route and for the process
+    functions behind them, and stores the results as json named after the
+    git commit, so runs can be compared across commits.
+
+    python benchmark.py
+    python benchmark.py --complaints 5000 --storms 5 --storm-complaints 500 --order priority
+    python benchmark.py --cdn
+    python benchmark.py --database-url mysql+pymysql://cs:cs@localhost/cs_bench --reset
+    python benchmark.py --compare bench_results/old.json
+    python benchmark.py --compare bench_results/old.json bench_results/new.json
+
+    Requests run one at a time, the chalice app keeps the current request
+    on the app object, so the throughput is that of a single container.
+"""
+
+__copyright__ = '(c) Martin Boliek, All Rights Reserved'
+__author__ = 'Martin Boliek'
+__author_email__ = 'martin@boliek.net'
+__version__ = '0.0.1'
+__date__ = '25 August 2018'
+__modules__ = ''
+
+# standard libraries
+import os                   # os operations
+import re                   # regular expressions
+import sys                  # system operations
+import json                 # json load and dump
+import time                 # time utilities
+import random               # complaint arrivals
+import logging              # quiet the per request logging
+import argparse             # command line arguement parsing
+import datetime             # date and time utilities
+import functools            # wraps
+import subprocess           # git commit of the run
+
+# process functions timed on every call, nested calls are timed inclusively
+process_functions = [
+    'get_gallery_page', 'get_content', 'get_pinner_from_email', 'get_reviewer_from_email',
+    'get_pinners_list', 'get_reviewers_list', 'get_complaint_list', 'get_complaint_stats',
+    'file_complaint', 'claim_review', 'bump_reviews', 'put_complaint', 'put_sqsmessage',
+    'ingest_complaint', 'file_complaint_batch', 'consume_ingest',
+    'next_review_item', 'fetch_review_item', 'get_review_item', 'get_sqsmessage', 'pop_review',
+    'extend_review', 'review_complaint', 'delete_sqsmessage', 'invalidate_gallery',
+    'mark_queued', 'reconcile', 'purge_takedowns'
+]
+
+routes = ['/pinner', '/cs_submit', '/re_pop', '/re_submit', '/manager']
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+# ------------------------------------------------------------------------------
+def percentiles(samples):
+    """ nearest rank percentiles of durations, in milliseconds, and the
+        throughput while busy with them
+        in: durations in seconds
+        return dict with count, mean, p50, p95, p99, max and per_second
+    """
+    samples = sorted(samples)
+    stats = {'count': len(samples)}
+    if not samples: return stats
+
+    busy = sum(samples)
+    stats['mean'] = round(busy / len(samples) * 1000, 3)
+    for name, q in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99), ('max', 1.0)):
+        stats[name] = round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+    stats['per_second'] = round(len(samples) / busy, 1) if busy else None
+
+    return stats
+
+
+# ------------------------------------------------------------------------------
+def instrument(process, samples):
+    """ Replaces the process functions with timed wrappers. The routes and
+        process itself look the functions up on the module at call time,
+        so every call is timed, including those from the prefetch thread.
+        in: process module, dict name -> list of durations to fill
+        return dict name -> original function, for restore
+    """
+    originals = {}
+    for name in process_functions:
+        func = getattr(process, name, None)
+        if func == None: continue
+        durations = samples.setdefault(name, [])
+
+        def timed(*args, __func=func, __durations=durations, **kwargs):
+            start = time.perf_counter()
+            try: return __func(*args, **kwargs)
+            finally: __durations.append(time.perf_counter() - start)
+
+        originals[name] = func
+        setattr(process, name, functools.wraps(func)(timed))
+
+    return originals
+
+
+# ------------------------------------------------------------------------------
+def git_commit():
+    """ the commit the benchmark ran on
+        return short hash, True if the tree has uncommitted changes
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here).decode().strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '-uno'], cwd=here).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+    return commit, dirty
+
+
+# ------------------------------------------------------------------------------
+def setup(args):
+    """ Points the secrets at the benchmark database and queues, creates and
+        loads the tables, and installs the local sqs, cache and cloudfront
+        backends.
+        return process module, app module, local sqs
+    """
+    secrets = {
+        'database_url': args.database_url,
+        'queue_name': 'cs_bench',
+        'ingest_mode': args.ingest,
+        'ingest_wal': args.wal,
+        'review_order': args.order
+    }
+    if args.cdn: secrets.update({'cdn_distribution_id': 'BENCH', 'cdn_page_paths': ['/pinner*']})
+    os.environ['CS_SECRETS'] = json.dumps(secrets)
+    os.environ['CS_INGEST_QUEUE'] = 'cs_bench_ingest'
+    for path in (args.wal, args.wal + '.offset'):
+        if os.path.exists(path): os.remove(path)
+
+    if args.database_url.startswith('sqlite:///'):
+        path = args.database_url[len('sqlite:///'):]
+        if path and os.path.exists(path): os.remove(path)
+    elif not args.reset:
+        sys.exit("refusing to use {} without --reset, its tables are dropped".format(args.database_url))
+
+    from chalicelib import process
+    from chalicelib.localsqs import LocalSQS
+    from chalicelib.localredis import LocalRedis
+    from chalicelib.localcdn import LocalCloudFront
+    import table_setup
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    table_setup.connect()
+    if args.reset:
+        table_setup.metadata.reflect()
+        table_setup.metadata.drop_all()
+        table_setup.metadata.clear()
+    table_setup.create_tables()
+    load(table_setup.metadata, args)
+
+    local = LocalSQS()
+    for name in (secrets['queue_name'], process.ingest_queue_name): local.create_queue(QueueName=name)
+    process.set_client('sqs', local)
+    if args.cache == 'redis': process.set_cache(process.RedisCache(LocalRedis()))
+    if args.cdn: process.set_client('cloudfront', LocalCloudFront())
+
+    import app
+
+    return process, app, local
+
+
+# ------------------------------------------------------------------------------
+def load(metadata, args, chunk=1000):
+    """ Loads the pinners, reviewers and contents, content i has the url
+        bench/i.jpg so a review page tells which content it is.
+    """
+    rng = random.Random(args.seed)
+    rows = {
+        'pinners': [{'name': 'pinner{}'.format(i), 'email': 'p{}@bench.example'.format(i)}
+                    for i in range(args.pinners)],
+        'reviewers': [{'name': 'reviewer{}'.format(i), 'email': 'r{}@bench.example'.format(i)}
+                      for i in range(args.reviewers)],
+        'contents': [{'url': 'bench/{}.jpg'.format(i + 1), 'display_status': 'good',
+                      'pinner_id': rng.randint(1, args.pinners)} for i in range(args.contents)]
+    }
+    for name in ('pinners', 'reviewers', 'contents'):
+        table = metadata.tables[name]
+        for i in range(0, len(rows[name]), chunk):
+            table.insert().execute(rows[name][i:i + chunk])
+
+
+# ------------------------------------------------------------------------------
+def make_complaints(args):
+    """ The order complaints arrive in. Ordinary complaints are spread over
+        all contents, each storm is a burst of storm_complaints about one
+        content dropped somewhere into them.
+        return list of content ids, set of storm content ids
+    """
+    rng = random.Random(args.seed)
+    events = [rng.randint(1, args.contents) for i in range(args.complaints)]
+    storms = set(rng.sample(range(1, args.contents + 1), min(args.storms, args.contents)))
+    for cid in storms:
+        at = rng.randint(0, len(events))
+        events[at:at] = [cid] * args.storm_complaints
+
+    return events, storms
+
+
+# ------------------------------------------------------------------------------
+class Driver(object):
+    """ Sends requests through the chalice test client and keeps the
+        duration of each, per route.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.samples = dict((route, []) for route in routes)
+        self.status = {}
+
+    # --------------------------------------------------------------------------
+    def get(self, route, query='', headers=None):
+        start = time.perf_counter()
+        response = self.client.http.get(route + ('?' + query if query else ''), headers=headers or {})
+        self.samples.setdefault(route, []).append(time.perf_counter() - start)
+        key = '{} {}'.format(route, response.status_code)
+        self.status[key] = self.status.get(key, 0) + 1
+
+        return response
+
+
+# ------------------------------------------------------------------------------
+def browse(driver, args, rng):
+    """ pinners page through the gallery, a share of them revalidating a
+        page they already have with its etag
+    """
+    cursor, etags = '', {}
+    for i in range(args.page_views):
+        query = 'limit={}'.format(args.page_size) + ('&cursor=' + cursor if cursor else '')
+        headers = {}
+        if cursor in etags and rng.random() < args.revalidate: headers['If-None-Match'] = etags[cursor]
+        response = driver.get('/pinner', query, headers)
+        if response.status_code == 200:
+            etags[cursor] = response.headers['ETag']
+            found = re.search(r'pinner\?cursor=(\d+)', response.body.decode())
+            cursor = found.group(1) if found else ''
+        else:
+            cursor = rng.choice(list(etags))
+
+
+# ------------------------------------------------------------------------------
+def submit(driver, args, events, rng):
+    """ files every complaint through cs_submit
+    """
+    for cid in events:
+        query = 'content_id={}&pinner=p{}@bench.example&display_status=good'.format(
+            cid, rng.randrange(args.pinners))
+        driver.get('/cs_submit', query)
+
+
+# ------------------------------------------------------------------------------
+def review(driver, args, storms, rng):
+    """ reviewers pop and decide reviews until the backlog is empty or
+        args.reviews decisions were made. Storm contents are found Bad,
+        other contents with probability args.bad.
+        return number of decisions
+    """
+    decisions = 0
+    body = driver.get('/re_pop').body.decode()
+    while 'name="complaint_id"' in body and (not args.reviews or decisions < args.reviews):
+        complaint_id = re.search(r'name="complaint_id" value="(\d+)"', body).group(1)
+        handle = re.search(r'name="sqs_handle" value="([^"]*)"', body).group(1)
+        cid = int(re.search(r'src="bench/(\d+)\.jpg"', body).group(1))
+        comp = 'Bad' if cid in storms or rng.random() < args.bad else 'Good'
+        query = 'complaint_id={}&sqs_handle={}&reviewer=r{}@bench.example&comp={}&next=1'.format(
+            complaint_id, handle, rng.randrange(args.reviewers), comp)
+        body = driver.get('/re_submit', query).body.decode()
+        decisions += 1
+
+    return decisions
+
+
+# ------------------------------------------------------------------------------
+def manage(driver, args):
+    """ managers page through the open complaints
+    """
+    cursor = ''
+    for i in range(args.manager_views):
+        query = 'limit={}'.format(args.page_size) + ('&cursor=' + cursor if cursor else '')
+        found = re.search(r'manager\?cursor=(\d+)', driver.get('/manager', query).body.decode())
+        cursor = found.group(1) if found else ''
+
+
+# ------------------------------------------------------------------------------
+def run(args):
+    """ Runs the phases in pipeline order: browse, submit, ingest (queue and
+        wal modes), manage the backlog, review it, reconcile the queue with
+        the database, and browse again.
+        return results dict
+    """
+    process, app, local = setup(args)
+    from chalice.test import Client
+
+    rng = random.Random(args.seed)
+    events, storms = make_complaints(args)
+    functions = {}
+    phases = {}
+    originals = instrument(process, functions)
+    try:
+        with Client(app.app) as client:
+            driver = Driver(client)
+            steps = [
+                ('browse', lambda: browse(driver, args, rng)),
+                ('submit', lambda: submit(driver, args, events, rng)),
+                ('ingest', lambda: process.consume_ingest(max_records=len(events))),
+                ('manage', lambda: manage(driver, args)),
+                ('review', lambda: review(driver, args, storms, rng)),
+                ('reconcile', lambda: process.reconcile(age=0)),
+                ('browse_after', lambda: browse(driver, args, rng))
+            ]
+            for name, step in steps:
+                start = time.perf_counter()
+                value = step()
+                phases[name] = {'seconds': round(time.perf_counter() - start, 3)}
+                if name == 'review': phases[name]['decisions'] = value
+                print("{:14s} {:8.2f} s".format(name, phases[name]['seconds']), file=sys.stderr)
+    finally:
+        for name, func in originals.items(): setattr(process, name, func)
+
+    commit, dirty = git_commit()
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'settings': dict((k, v) for k, v in vars(args).items() if k not in ('out', 'compare', 'verbose')),
+        'phases': phases,
+        'routes': dict((route, percentiles(s)) for route, s in driver.samples.items() if s),
+        'functions': dict((name, percentiles(s)) for name, s in functions.items() if s),
+        'status': driver.status,
+        'aws': process.aws_timing,
+        'cache': process.cache_stats,
+        'sqs': process.sqs_stats,
+        'review': process.review_stats,
+        'purge': process.get_purge_stats(),
+        'queue_depth': local.depth(process.get_queue_url()),
+        'complaints': dict(process.get_complaint_stats()['process_status'])
+    }
+
+    return results
+
+
+# ------------------------------------------------------------------------------
+def report(results):
+    """ prints the route and function latency of a run
+    """
+    print("commit {}{}, {}, {}".format(results['commit'], ' (dirty)' if results['dirty'] else '',
+        results['date'], ', '.join('{}={}'.format(k, results['settings'][k])
+        for k in ('order', 'ingest', 'cache', 'complaints', 'storms', 'storm_complaints'))))
+    for section in ('routes', 'functions'):
+        print("{:24s} {:>8s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}".format(
+            section[:-1], 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'per s'))
+        for name, s in sorted(results[section].items()):
+            print("{:24s} {:8d} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:9.1f}".format(
+                name, s['count'], s['p50'], s['p95'], s['p99'], s['max'], s['per_second']))
+    for name, s in sorted(results.get('purge', {}).items()):
+        t = s['time_to_purge']
+        print("purge {:6s} {} takedowns in {} calls, {} waiting, time to purge p50 {} ms, max {} ms".format(
+            name, s['purged'], s['calls'], s['waiting'], t['p50'], t['max']))
+    print("status {}".format(results['status']))
+    print("complaints {}, review queue depth {}".format(results['complaints'], results['queue_depth']))
+
+
+# ------------------------------------------------------------------------------
+def compare(base, new):
+    """ prints the change of p50, p95 and p99 of every route and function
+        from one run to another, negative is faster
+    """
+    print("{} -> {}".format(base['commit'], new['commit']))
+    if base['settings'] != new['settings']: print("note: the runs used different settings")
+    for section in ('routes', 'functions'):
+        print("{:24s} {:>18s} {:>18s} {:>18s}".format(section[:-1], 'p50 ms', 'p95 ms', 'p99 ms'))
+        for name in sorted(set(base[section]) | set(new[section])):
+            cells = []
+            for q in ('p50', 'p95', 'p99'):
+                a = base[section].get(name, {}).get(q)
+                b = new[section].get(name, {}).get(q)
+                if a == None or b == None:
+                    cells.append('{:>18s}'.format('-' if b == None else '{:.3f} new'.format(b)))
+                else:
+                    cells.append('{:9.3f} {:>+7.1%} '.format(b, (b - a) / a if a else 0.0))
+            print("{:24s} {}".format(name, ' '.join(cells)))
+
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load test the complaint to takedown pipeline')
+    parser.add_argument('--database-url', default='sqlite:////tmp/cs_bench.db',
+                        help='sqlite file (recreated) or a database whose tables --reset drops')
+    parser.add_argument('--reset', action='store_true', help='drop the tables of a non sqlite database first')
+    parser.add_argument('--pinners', type=int, default=200, help='pinners filing complaints')
+    parser.add_argument('--contents', type=int, default=2000, help='contents in the gallery')
+    parser.add_argument('--reviewers', type=int, default=5, help='reviewers deciding reviews')
+    parser.add_argument('--complaints', type=int, default=1000, help='ordinary complaints')
+    parser.add_argument('--storms', type=int, default=3, help='contents hit by a complaint storm')
+    parser.add_argument('--storm-complaints', type=int, default=200, help='complaints per storm')
+    parser.add_argument('--page-views', type=int, default=300, help='gallery pages viewed per browse phase')
+    parser.add_argument('--page-size', type=int, default=50, help='rows per gallery and manager page')
+    parser.add_argument('--revalidate', type=float, default=0.3, help='share of page views sent with an etag')
+    parser.add_argument('--manager-views', type=int, default=50, help='manager pages viewed')
+    parser.add_argument('--reviews', type=int, default=0, help='most review decisions, 0 for the whole backlog')
+    parser.add_argument('--bad', type=float, default=0.2, help='share of ordinary contents found Bad')
+    parser.add_argument('--order', choices=['fifo', 'priority'], default='fifo', help='review order')
+    parser.add_argument('--ingest', choices=['sync', 'queue', 'wal'], default='sync', help='cs_submit ingest mode')
+    parser.add_argument('--wal', default='/tmp/cs_bench_ingest.wal', help='write ahead log of the wal ingest mode')
+    parser.add_argument('--cache', choices=['lru', 'redis'], default='lru', help='cache backend, redis is local')
+    parser.add_argument('--cdn', action='store_true', help='purge takedowns from a local cloudfront too')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--out', help='results file, default bench_results/<date>-<commit>.json')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='compare this run to a results file, or two results files without running')
+    parser.add_argument('--verbose', action='store_true', help='keep the process logging')
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 2: parser.error('--compare takes one or two results files')
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as f: base = json.load(f)
+        with open(args.compare[1]) as f: compare(base, json.load(f))
+        sys.exit(0)
+
+    results = run(args)
+    report(results)
+
+    out = args.out or os.path.join(here, 'bench_results', '{}-{}{}.json'.format(
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), results['commit'], '-dirty' if results['dirty'] else ''))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f: json.dump(results, f, indent=2, sort_keys=True)
+    print("results in {}".format(out))
+
+    if args.compare:
+        with open(args.compare[0]) as f: compare(json.load(f), results)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+    build_templates.py
+
+    Precompile the jinja2 templates in chalicelib/templates into python
+    modules in chalicelib/templates_compiled, which app.py loads instead of
+    parsing the templates on every cold start. A manifest of the source
+    hashes goes with them, and app.py falls back to the sources when a
+    template changed after the build. Run before chalice deploy.
+
+    python build_templates.py           compile the templates
+    python build_templates.py --bench   compare cold and warm render latency
+"""
+
+__copyright__ = '(c) Martin Boliek, All Rights Reserved'
+__author__ = 'Martin Boliek'
+__author_email__ = 'martin@boliek.net'
+__version__ = '0.0.1'
+__date__ = '25 August 2018'
+__modules__ = ''
+
+# standard libraries
+import os                   # os operations
+import sys                  # system operations
+import json                 # manifest
+import time                 # time utilities
+import shutil               # remove directories
+import argparse             # command line arguement parsing
+import compileall           # byte compile the template modules
+import py_compile           # pyc invalidation modes
+
+# special libraries
+from jinja2 import Environment, FileSystemLoader, ModuleLoader
+
+# app template settings, so the compiled templates match what app.py renders
+import app
+
+# sample page data for the benchmark
+sample = {
+    'contents': [{'content_id': i, 'url': 'cat{}.jpg'.format(i)} for i in range(12)],
+    'pinners': [{'pinner_id': i, 'email': 'p{}@example.com'.format(i)} for i in range(4)],
+    'reviewers': [{'reviewer_id': i, 'email': 'r{}@example.com'.format(i)} for i in range(3)],
+    'reviewer': 'r0@example.com', 'open_complaints': 3, 'complaint_type': 'objectionable',
+    'first_complaint': '2018-08-25 10:00:00', 'last_complaint': '2018-08-25 10:05:00', 'near_duplicates': 2,
+    'pending': [{'complaint_id': i, 'content_id': i, 'complaint_timestamp': '2018-08-25 10:00:00'} for i in range(20)],
+    'stats': {
+        'process_status': {'complaint': 20, 'done': 80},
+        'display_status': {'good': 90, 'objectionable': 10},
+        'complaint_type': {'objectionable': 100},
+        'oldest_pending': 60,
+        'per_hour': [('2018-08-25 10:00', 100)],
+        'hours': 24
+    },
+    'url': 'cat0.jpg', 'complaint_id': 1, 'sqs_handle': 'handle', 'cursor': 12, 'limit': 12
+}
+
+
+# ------------------------------------------------------------------------------
+def compile_templates():
+    """ Compile every template to a python module and byte compile the
+        modules so a container does not have to.
+        return number of templates compiled
+    """
+    if os.path.isdir(app.compiled_dir): shutil.rmtree(app.compiled_dir)
+
+    env = Environment(loader=FileSystemLoader(app.template_dir), **app.template_options)
+    names = env.list_templates(extensions=['html'])
+    env.compile_templates(app.compiled_dir, zip=None, ignore_errors=False,
+                          log_function=lambda text: print(text))
+
+    # unchecked pycs stay valid when deployment packaging changes file times
+    options = {}
+    if hasattr(py_compile, 'PycInvalidationMode'):
+        options['invalidation_mode'] = py_compile.PycInvalidationMode.UNCHECKED_HASH
+    compileall.compile_dir(app.compiled_dir, quiet=1, **options)
+
+    # app.py only loads the modules while the sources still match
+    with open(os.path.join(app.compiled_dir, app.manifest_name), 'w') as f:
+        json.dump(app.template_hashes(), f, indent=1, sort_keys=True)
+
+    return len(names)
+
+
+# ------------------------------------------------------------------------------
+def render_time(env, name, repeat):
+    """ Time the first render of a template in a fresh environment (cold)
+        and the average of repeat renders after it (warm).
+        return cold seconds, warm seconds
+    """
+    start = time.perf_counter()
+    t = env.get_template(name)
+    t.render(my_dict=sample, complaint_id=1)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(repeat): t.render(my_dict=sample, complaint_id=1)
+    warm = (time.perf_counter() - start) / repeat
+
+    return cold, warm
+
+
+# ------------------------------------------------------------------------------
+def bench(repeat=200):
+    """ Compare cold and warm render latency of the source templates and the
+        precompiled modules, in milliseconds.
+    """
+    if not os.path.isdir(app.compiled_dir):
+        print("no compiled templates, run build_templates.py first")
+        return
+
+    names = sorted(n for n in os.listdir(app.template_dir) if n.endswith('.html'))
+    print("{:24s} {:>12s} {:>12s} {:>12s} {:>12s}".format(
+        'template', 'source cold', 'module cold', 'source warm', 'module warm'))
+    totals = [0.0, 0.0, 0.0, 0.0]
+    for name in names:
+        source = Environment(loader=FileSystemLoader(app.template_dir), **app.template_options)
+        module = Environment(loader=ModuleLoader(app.compiled_dir), **app.template_options)
+        sc, sw = render_time(source, name, repeat)
+        mc, mw = render_time(module, name, repeat)
+        row = [sc * 1000, mc * 1000, sw * 1000, mw * 1000]
+        totals = [a + b for a, b in zip(totals, row)]
+        print("{:24s} {:12.3f} {:12.3f} {:12.3f} {:12.3f}".format(name, *row))
+    print("{:24s} {:12.3f} {:12.3f} {:12.3f} {:12.3f}".format('total', *totals))
+
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='precompile the jinja2 templates')
+    parser.add_argument('--bench', action='store_true', help='compare cold and warm render latency')
+    parser.add_argument('--repeat', type=int, default=200, help='renders per warm measurement')
+    args = parser.parse_args()
+
+    if args.bench:
+        bench(args.repeat)
+    else:
+        print("compiled {} templates into {}".format(compile_templates(), app.compiled_dir))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+    mb localcdn
+
+    in-memory stand in for the boto3 cloudfront client, used to exercise the
+    takedown purges in process.py without AWS
+"""
+
+__copyright__ = '(c) Martin Boliek, All Rights Reserved'
+__author__ = 'Martin Boliek'
+__author_email__ = 'martin@boliek.net'
+__version__ = '0.0.1'
+__date__ = '25 August 2018'
+__modules__ = ''
+
+# standard libraries
+import time                 # time utilities
+import uuid                 # invalidation ids
+import datetime             # create times
+import threading            # locks
+import collections          # counters
+
+# special libraries
+from botocore.exceptions import ClientError
+
+
+# ------------------------------------------------------------------------------
+class LocalCloudFront(object):
+    """ Implements the part of the boto3 cloudfront client that the purge
+        backend uses: create_invalidation and get_invalidation. Nothing is
+        cached, an invalidation only records its paths and completes after
+        complete_after seconds. Like cloudfront, a batch with a caller
+        reference seen before is not created again, and more than
+        max_paths paths in progress is refused. Set fail to a function
+        (operation) returning an error code, or None, to make calls fail.
+    """
+    def __init__(self, complete_after=0.0, max_paths=3000, clock=time.time):
+        self.complete_after = complete_after
+        self.max_paths = max_paths
+        self.clock = clock
+        self.invalidations = collections.OrderedDict()  # id -> invalidation
+        self.references = {}                            # caller reference -> id
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.fail = None
+
+    # --------------------------------------------------------------------------
+    def error(self, code, operation):
+        """ builds the ClientError boto3 would raise
+        """
+        return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+    # --------------------------------------------------------------------------
+    def status(self, invalidation):
+        """ an invalidation's status at the current time
+        """
+        done = self.clock() - invalidation['created'] >= self.complete_after
+        return 'Completed' if done else 'InProgress'
+
+    # --------------------------------------------------------------------------
+    def response(self, invalidation):
+        """ the invalidation as cloudfront describes it
+        """
+        return {'Invalidation': {
+            'Id': invalidation['Id'],
+            'Status': self.status(invalidation),
+            'CreateTime': datetime.datetime.utcfromtimestamp(invalidation['created']),
+            'InvalidationBatch': invalidation['InvalidationBatch']
+        }}
+
+    # --------------------------------------------------------------------------
+    def create_invalidation(self, DistributionId, InvalidationBatch, **kwargs):
+        self.calls['create_invalidation'] += 1
+        if self.fail:
+            code = self.fail('CreateInvalidation')
+            if code: raise self.error(code, 'CreateInvalidation')
+
+        with self.lock:
+            reference = (DistributionId, InvalidationBatch['CallerReference'])
+            if reference in self.references: return self.response(self.invalidations[self.references[reference]])
+
+            paths = InvalidationBatch['Paths']
+            if paths['Quantity'] != len(paths['Items']): raise self.error('InconsistentQuantities', 'CreateInvalidation')
+            running = sum(i['InvalidationBatch']['Paths']['Quantity'] for i in self.invalidations.values()
+                          if i['DistributionId'] == DistributionId and self.status(i) == 'InProgress')
+            if running + paths['Quantity'] > self.max_paths:
+                raise self.error('TooManyInvalidationsInProgress', 'CreateInvalidation')
+
+            invalidation = {
+                'Id': 'I' + uuid.uuid4().hex[:13].upper(),
+                'DistributionId': DistributionId,
+                'InvalidationBatch': InvalidationBatch,
+                'created': self.clock()
+            }
+            self.invalidations[invalidation['Id']] = invalidation
+            self.references[reference] = invalidation['Id']
+
+        return self.response(invalidation)
+
+    # --------------------------------------------------------------------------
+    def get_invalidation(self, DistributionId, Id, **kwargs):
+        self.calls['get_invalidation'] += 1
+        invalidation = self.invalidations.get(Id)
+        if invalidation == None or invalidation['DistributionId'] != DistributionId:
+            raise self.error('NoSuchInvalidation', 'GetInvalidation')
+
+        return self.response(invalidation)
+
+    # --------------------------------------------------------------------------
+    def paths(self, DistributionId=None):
+        """ every path invalidated so far, in order, for checks
+        """
+        return [path for i in self.invalidations.values()
+                if DistributionId in (None, i['DistributionId'])
+                for path in i['InvalidationBatch']['Paths']['Items']]
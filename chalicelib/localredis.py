@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+    mb localredis
+
+    in-memory stand in for a redis client, used to exercise the shared cache
+    backend in process.py without a redis server
+"""
+
+__copyright__ = '(c) Martin Boliek, All Rights Reserved'
+__author__ = 'Martin Boliek'
+__author_email__ = 'martin@boliek.net'
+__version__ = '0.0.1'
+__date__ = '25 August 2018'
+__modules__ = ''
+
+# standard libraries
+import time                 # time utilities
+import fnmatch              # glob style key matching
+import threading            # locks
+import collections          # counters
+
+
+# ------------------------------------------------------------------------------
+class LocalRedis(object):
+    """ Implements the part of the redis client that the cache uses: get, set
+        with an expiry, delete, scan_iter, expire and the hash commands hset,
+        hget, hgetall and hdel. Values are stored as bytes like redis does. Several process.RedisCache objects can share one
+        LocalRedis to act like several containers sharing a server.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.data = {}                              # key -> (bytes, expires at or None)
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def live(self, key):
+        """ returns the stored entry for a key, dropping it if it expired
+        """
+        entry = self.data.get(key)
+        if entry != None and entry[1] != None and entry[1] <= self.clock():
+            del self.data[key]
+            entry = None
+        return entry
+
+    # --------------------------------------------------------------------------
+    def get(self, key):
+        self.calls['get'] += 1
+        with self.lock:
+            entry = self.live(key)
+        return entry[0] if entry != None else None
+
+    # --------------------------------------------------------------------------
+    def set(self, key, value, ex=None):
+        self.calls['set'] += 1
+        if not isinstance(value, bytes): value = str(value).encode()
+        with self.lock:
+            self.data[key] = (value, self.clock() + ex if ex else None)
+        return True
+
+    # --------------------------------------------------------------------------
+    def delete(self, *keys):
+        self.calls['delete'] += 1
+        deleted = 0
+        with self.lock:
+            for key in keys:
+                if self.live(key) != None:
+                    del self.data[key]
+                    deleted += 1
+        return deleted
+
+    # --------------------------------------------------------------------------
+    def expire(self, key, seconds):
+        self.calls['expire'] += 1
+        with self.lock:
+            entry = self.live(key)
+            if entry == None: return False
+            self.data[key] = (entry[0], self.clock() + seconds)
+        return True
+
+    # --------------------------------------------------------------------------
+    def hset(self, key, field, value):
+        self.calls['hset'] += 1
+        if not isinstance(value, bytes): value = str(value).encode()
+        with self.lock:
+            entry = self.live(key)
+            if entry == None:
+                entry = ({}, None)
+                self.data[key] = entry
+            added = field.encode() not in entry[0]
+            entry[0][field.encode()] = value
+        return int(added)
+
+    # --------------------------------------------------------------------------
+    def hget(self, key, field):
+        self.calls['hget'] += 1
+        with self.lock:
+            entry = self.live(key)
+        return entry[0].get(field.encode()) if entry != None else None
+
+    # --------------------------------------------------------------------------
+    def hgetall(self, key):
+        self.calls['hgetall'] += 1
+        with self.lock:
+            entry = self.live(key)
+            return dict(entry[0]) if entry != None else {}
+
+    # --------------------------------------------------------------------------
+    def hdel(self, key, *fields):
+        self.calls['hdel'] += 1
+        deleted = 0
+        with self.lock:
+            entry = self.live(key)
+            if entry != None:
+                for field in fields:
+                    if entry[0].pop(field.encode(), None) != None: deleted += 1
+        return deleted
+
+    # --------------------------------------------------------------------------
+    def scan_iter(self, match='*'):
+        self.calls['scan_iter'] += 1
+        with self.lock:
+            keys = [k for k in list(self.data) if self.live(k) != None and fnmatch.fnmatchcase(k, match)]
+        return iter(keys)
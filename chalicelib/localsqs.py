@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+    mb localsqs
+
+    in-memory stand in for the boto3 sqs client, used to exercise the queue
+    code in process.py without AWS
+"""
+
+__copyright__ = '(c) Martin Boliek, All Rights Reserved'
+__author__ = 'Martin Boliek'
+__author_email__ = 'martin@boliek.net'
+__version__ = '0.0.1'
+__date__ = '25 August 2018'
+__modules__ = ''
+
+# standard libraries
+import time                 # time utilities
+import uuid                 # unique ids
+import hashlib              # message digests
+import threading            # locks
+import collections          # ordered dicts and counters
+
+# special libraries
+from botocore.exceptions import ClientError
+
+
+# ------------------------------------------------------------------------------
+class LocalSQS(object):
+    """ Implements the part of the boto3 sqs client that process.py uses.
+        Messages live in memory and follow the sqs visibility timeout rules,
+        so a received message is hidden until it is deleted or its timeout
+        runs out. Every call is counted in calls. Set fail to a function
+        (operation, entry) returning an error code, or None, to make single
+        batch entries fail.
+    """
+    def __init__(self, visibility_timeout=30, clock=time.time):
+        self.visibility_timeout = visibility_timeout
+        self.clock = clock
+        self.queues = {}                            # url -> OrderedDict of messages
+        self.handles = {}                           # receipt handle -> message
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.fail = None
+
+    # --------------------------------------------------------------------------
+    def error(self, code, operation):
+        """ builds the ClientError boto3 would raise
+        """
+        return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+    # --------------------------------------------------------------------------
+    def queue(self, url, operation):
+        """ returns the messages of a queue
+        """
+        if url not in self.queues: raise self.error('AWS.SimpleQueueService.NonExistentQueue', operation)
+        return self.queues[url]
+
+    # --------------------------------------------------------------------------
+    def create_queue(self, QueueName, **kwargs):
+        self.calls['create_queue'] += 1
+        url = 'local://sqs/' + QueueName
+        with self.lock: self.queues.setdefault(url, collections.OrderedDict())
+        return {'QueueUrl': url}
+
+    # --------------------------------------------------------------------------
+    def get_queue_url(self, QueueName, **kwargs):
+        self.calls['get_queue_url'] += 1
+        url = 'local://sqs/' + QueueName
+        self.queue(url, 'GetQueueUrl')
+        return {'QueueUrl': url}
+
+    # --------------------------------------------------------------------------
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self.calls['send_message'] += 1
+        with self.lock:
+            queue = self.queue(QueueUrl, 'SendMessage')
+            message = {
+                'MessageId': str(uuid.uuid4()),
+                'Body': MessageBody,
+                'MD5OfBody': hashlib.md5(MessageBody.encode()).hexdigest(),
+                'Attributes': {'SentTimestamp': str(int(self.clock() * 1000)), 'ApproximateReceiveCount': '0'},
+                'visible_at': self.clock() + kwargs.get('DelaySeconds', 0),
+                'handle': None
+            }
+            queue[message['MessageId']] = message
+        return {'MessageId': message['MessageId'], 'MD5OfMessageBody': message['MD5OfBody']}
+
+    # --------------------------------------------------------------------------
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.calls['send_message_batch'] += 1
+        if len(Entries) > 10: raise self.error('AWS.SimpleQueueService.TooManyEntriesInBatchRequest', 'SendMessageBatch')
+        successful, failed = [], []
+        for e in Entries:
+            code = self.fail and self.fail('SendMessageBatch', e)
+            if code:
+                failed.append({'Id': e['Id'], 'SenderFault': False, 'Code': code})
+                continue
+            response = self.send_message(QueueUrl, e['MessageBody'], DelaySeconds=e.get('DelaySeconds', 0))
+            self.calls['send_message'] -= 1
+            successful.append({'Id': e['Id'], 'MessageId': response['MessageId'],
+                               'MD5OfMessageBody': response['MD5OfMessageBody']})
+        return {'Successful': successful, 'Failed': failed}
+
+    # --------------------------------------------------------------------------
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=None, **kwargs):
+        self.calls['receive_message'] += 1
+        if VisibilityTimeout == None: VisibilityTimeout = self.visibility_timeout
+        now = self.clock()
+        messages = []
+        with self.lock:
+            queue = self.queue(QueueUrl, 'ReceiveMessage')
+            for message in queue.values():
+                if len(messages) >= MaxNumberOfMessages: break
+                if message['visible_at'] > now: continue
+
+                # a new receipt handle for every receive, the old one is dead
+                if message['handle'] != None: self.handles.pop(message['handle'], None)
+                message['handle'] = str(uuid.uuid4())
+                message['visible_at'] = now + VisibilityTimeout
+                count = int(message['Attributes']['ApproximateReceiveCount']) + 1
+                message['Attributes']['ApproximateReceiveCount'] = str(count)
+                self.handles[message['handle']] = (QueueUrl, message)
+                messages.append({
+                    'MessageId': message['MessageId'],
+                    'ReceiptHandle': message['handle'],
+                    'MD5OfBody': message['MD5OfBody'],
+                    'Body': message['Body'],
+                    'Attributes': dict(message['Attributes'])
+                })
+
+        if messages: return {'Messages': messages}
+        return {}
+
+    # --------------------------------------------------------------------------
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self.calls['delete_message'] += 1
+        with self.lock:
+            queue = self.queue(QueueUrl, 'DeleteMessage')
+            if ReceiptHandle not in self.handles: raise self.error('ReceiptHandleIsInvalid', 'DeleteMessage')
+            url, message = self.handles.pop(ReceiptHandle)
+            queue.pop(message['MessageId'], None)
+        return {}
+
+    # --------------------------------------------------------------------------
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.calls['delete_message_batch'] += 1
+        if len(Entries) > 10: raise self.error('AWS.SimpleQueueService.TooManyEntriesInBatchRequest', 'DeleteMessageBatch')
+        successful, failed = [], []
+        for e in Entries:
+            code = self.fail and self.fail('DeleteMessageBatch', e)
+            if code:
+                failed.append({'Id': e['Id'], 'SenderFault': False, 'Code': code})
+                continue
+            try:
+                self.delete_message(QueueUrl, e['ReceiptHandle'])
+                successful.append({'Id': e['Id']})
+            except ClientError as ex:
+                failed.append({'Id': e['Id'], 'SenderFault': True, 'Code': ex.response['Error']['Code']})
+            self.calls['delete_message'] -= 1
+        return {'Successful': successful, 'Failed': failed}
+
+    # --------------------------------------------------------------------------
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        self.calls['change_message_visibility'] += 1
+        with self.lock:
+            self.queue(QueueUrl, 'ChangeMessageVisibility')
+            if ReceiptHandle not in self.handles: raise self.error('ReceiptHandleIsInvalid', 'ChangeMessageVisibility')
+            url, message = self.handles[ReceiptHandle]
+            message['visible_at'] = self.clock() + VisibilityTimeout
+        return {}
+
+    # --------------------------------------------------------------------------
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        self.calls['change_message_visibility_batch'] += 1
+        successful, failed = [], []
+        for e in Entries:
+            try:
+                self.change_message_visibility(QueueUrl, e['ReceiptHandle'], e['VisibilityTimeout'])
+                successful.append({'Id': e['Id']})
+            except ClientError as ex:
+                failed.append({'Id': e['Id'], 'SenderFault': True, 'Code': ex.response['Error']['Code']})
+            self.calls['change_message_visibility'] -= 1
+        return {'Successful': successful, 'Failed': failed}
+
+    # --------------------------------------------------------------------------
+    def depth(self, QueueUrl):
+        """ number of messages in the queue, visible or in flight
+        """
+        with self.lock: return len(self.queue(QueueUrl, 'GetQueueAttributes'))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+    mb nearby
+
+    perceptual hashes of content images and a BK-tree to find the near
+    duplicates of an image, used by process.py to review visually identical
+    contents together. Hashing needs Pillow, the tree does not.
+"""
+
+__copyright__ = '(c) Martin Boliek, All Rights Reserved'
+__author__ = 'Martin Boliek'
+__author_email__ = 'martin@boliek.net'
+__version__ = '0.0.1'
+__date__ = '25 August 2018'
+__modules__ = ''
+
+# standard libraries
+import concurrent.futures   # process pool
+
+# special libraries, only the hashing job needs Pillow
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+hash_size = 8               # 8 x 8 gradient bits, a 64 bit hash
+hash_chunk = 64             # files per pool task
+
+
+# ------------------------------------------------------------------------------
+def dhash(path):
+    """ difference hash of an image: the image is shrunk to 9 x 8 grey
+        pixels and each bit tells whether a pixel is brighter than its right
+        neighbour. Rescaling, recompression and small edits change few bits.
+        in: image file path
+        return 64 bit int
+    """
+    if Image == None: raise RuntimeError("hashing images needs Pillow (pip install Pillow)")
+
+    with Image.open(path) as image:
+        pixels = list(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            value = (value << 1) | (left > pixels[row * (hash_size + 1) + col + 1])
+
+    return value
+
+
+# ------------------------------------------------------------------------------
+def hash_file(item):
+    """ dhash for the process pool, a missing or unreadable file is not an
+        error
+        in: (key, image file path)
+        return key, hash or None
+    """
+    key, path = item
+    try: return key, dhash(path)
+    except (OSError, ValueError): return key, None
+
+
+# ------------------------------------------------------------------------------
+def hash_files(items, workers=None, chunk=10000):
+    """ hashes image files in a pool of processes, decoding images is cpu
+        bound. Files are submitted chunk at a time so millions of them do
+        not queue up in memory.
+        in: iterable of (key, path), worker processes (default one per cpu),
+            files per chunk
+        return iterator of (key, hash or None), in order
+    """
+    if Image == None: raise RuntimeError("hashing images needs Pillow (pip install Pillow)")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= chunk:
+                for result in pool.map(hash_file, batch, chunksize=hash_chunk): yield result
+                batch = []
+        for result in pool.map(hash_file, batch, chunksize=hash_chunk): yield result
+
+
+# ------------------------------------------------------------------------------
+def hamming(a, b):
+    """ number of bits two hashes differ in
+    """
+    return bin(a ^ b).count('1')
+
+
+# ------------------------------------------------------------------------------
+def to_signed(value):
+    """ a 64 bit hash as a signed BIGINT column value
+    """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+# ------------------------------------------------------------------------------
+def to_unsigned(value):
+    """ a signed BIGINT column value as a 64 bit hash
+    """
+    return value + (1 << 64) if value < 0 else value
+
+
+# ------------------------------------------------------------------------------
+class BKTree(object):
+    """ Burkhard-Keller tree over hashes with the hamming distance. Every
+        child of a node is keyed by its distance to the node, so by the
+        triangle inequality a search within d of a hash only descends into
+        children keyed within d of the node's distance, a small part of the
+        tree for small d. Equal hashes share a node.
+    """
+    def __init__(self):
+        self.root = None            # [hash, items, {distance: child}]
+        self.size = 0
+
+    # --------------------------------------------------------------------------
+    def __len__(self):
+        return self.size
+
+    # --------------------------------------------------------------------------
+    def add(self, value, item):
+        """ adds an item under a hash
+        """
+        self.size += 1
+        if self.root == None:
+            self.root = [value, [item], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child == None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    # --------------------------------------------------------------------------
+    def find(self, value, distance):
+        """ items whose hash is within distance of a hash
+            return list of (distance, item), nearest first
+        """
+        found = []
+        stack = [self.root] if self.root != None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= distance: found += [(d, item) for item in node[1]]
+            for key, child in node[2].items():
+                if d - distance <= key <= d + distance: stack.append(child)
+
+        return sorted(found, key=lambda f: f[0])
@@ -22,6 +22,19 @@ import copy                 # copy data structures
 import time                 # time utilities
 import datetime             # date and time utilities
 import platform             # platform
+import threading            # locks
+import collections          # deques
+import bisect               # sorted list search
+import hashlib              # etags
+import uuid                 # ingest ids
+import csv                  # complaint feeds
+import urllib.parse         # image paths
+from inspect import isfunction, isgeneratorfunction   # functions to trace, sqlalchemy exports its own inspect
+import functools            # wraps
+
+# import timing, module load time broken down by phase
+import_start = time.time()
+import_timing = {}
 
 # logging setup
 import logging
@@ -34,35 +47,161 @@ logging.basicConfig(level=logging.INFO,
     datefmt='%y-%m-%dT%H:%M:%S%Z')
 
 # special libraries
+import_timing['logging'] = round(time.time() - import_start, 4)
+import_mark = time.time()
 import boto3 
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+import_timing['boto3'] = round(time.time() - import_mark, 4)
+import_mark = time.time()
 from sqlalchemy import *
+from sqlalchemy.pool import QueuePool, NullPool
 import sqlalchemy
+import_timing['sqlalchemy'] = round(time.time() - import_mark, 4)
+import_mark = time.time()
 
 # globals
 AWSregion = 'us-west-2'
 session = boto3.Session(region_name=AWSregion)
-s3 = boto3.client('s3')
-gp_obj = s3.get_object(Bucket='boliek', Key='secrets.json')
-gp = json.loads(gp_obj['Body'].read())
+
+# aws clients, created once per container and shared by every call
+aws_config = Config(
+    region_name=AWSregion,
+    max_pool_connections=10,            # pooled, kept alive https connections
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=25,                    # above the 20 s sqs long poll limit
+    retries={'max_attempts': 3, 'mode': 'standard'}
+)
+aws_clients = {}
+aws_timing = {}                         # 'service.operation' -> calls, seconds, max
+
+# secrets, loaded on first use, see get_secrets
+secrets_bucket = 'boliek'
+secrets_key = 'secrets.json'
+secrets_ttl = 300                       # seconds before the secrets are read again
+secrets_cache = {'secrets': None, 'loaded': 0.0}
 
 # s3 buckets
 s3_bucket = 'animals'
 s3_baseurl = 'https://s3-us-west-2.amazonaws.com/boliek-public'
 
 # sqs queue
-queue_name = gp['queue_name']
-queue_url = gp['queue_url']
-
-# database setup
-mysql = "mysql+pymysql://{user}:{password}@{server}/{database}".format(
-    user=gp['user'], 
-    password=gp['password'],
-    server=gp['server'],
-    database=gp['database']
-)
-db = create_engine(mysql, echo=False)
-#db = create_engine('sqlite:///content_safety.db', echo=False)
-metadata = MetaData(db)
+queue_url = None            # from the secrets, or resolved from the queue name
+sqs_batch_size = 10         # most messages sqs returns per receive
+sqs_visibility = 600        # ten minutes for a reviewer to act
+sqs_hold = 60               # seconds a buffered message stays leased to this container
+sqs_buffer = collections.deque()
+sqs_lock = threading.Lock()
+sqs_stats = {'receives': 0, 'received': 0, 'served': 0, 'expired': 0, 'released': 0}
+sqs_batch_wait = 1.0        # seconds a buffered send or delete may wait for a batch
+
+# database setup, the engine is created on first use, see get_db
+db = None
+metadata = None
+
+# connection pool, any of these can be set in the secrets under 'pool'
+pool_config = {
+    'size': 2,              # connections kept open per container
+    'overflow': 3,          # extra connections allowed under load
+    'timeout': 5,           # seconds to wait for a free connection
+    'recycle': 280,         # seconds before a connection is replaced, under the rds idle cutoff
+    'pre_ping': True,       # test a connection before using it
+    'null': False           # no pooling, for an external proxy such as rds proxy
+}
+pool_stats = {'checkouts': 0, 'wait_seconds': 0.0, 'wait_max': 0.0, 'exhausted': 0, 'timeouts': 0, 'connects': 0}
+
+# table registry, each table is reflected once per container and reused
+table_names = ['pinners', 'contents', 'reviewers', 'complaints', 'pending_reviews', 'content_hashes',
+               'pending_purges']
+tables = {}
+table_lock = threading.RLock()  # one thread reflects at a time, see get_table
+table_stats = {'reflected': 0, 'avoided': 0}
+record_types = {}           # column names -> Record class, see record_type
+
+# listing pages
+page_limit = 50             # default rows per page
+page_limit_max = 500        # largest page a caller can ask for
+
+# read through cache for lookups, see cached
+cache = None                # backend, an LRUCache unless set_cache installs another
+cache_size = 2000           # entries kept by the in-memory backend
+cache_ttl = {               # seconds, pinners and reviewers are not changed by this system
+    'content': 300,
+    'group': 300,           # near duplicate group, set when a content is indexed
+    'pinner': 3600,
+    'reviewer': 3600,
+    'pinners': 3600,
+    'reviewers': 3600
+}
+cache_stats = {}            # kind -> hits, misses, invalidated, errors
+gallery_ttl = 300           # seconds a rendered pinner gallery page is kept
+
+# takedown propagation, see purge_takedowns
+purge_queues = None         # PurgeQueue per purge backend, built by get_purge_queues
+purge_wait = 10             # seconds a cdn purge waits to coalesce with further takedowns
+purge_interval = 30         # fewest seconds between two cdn invalidations
+purge_max = 500             # takedowns per cdn invalidation, cloudfront allows 3000 paths in progress
+
+# complaint ingestion, the secrets 'ingest_mode' picks the path, see ingest_complaint
+ingest_modes = ('sync', 'queue', 'wal')     # file at once, buffer in sqs, buffer in a local log
+ingest_queue_name = os.environ.get('CS_INGEST_QUEUE')  # set at deploy, it also subscribes app.ingest_consumer
+ingest_url = None           # resolved from the ingest queue name
+ingest_wal = '/tmp/cs_ingest.wal'   # write ahead log when the secrets do not name one
+ingest_batch = 100          # complaints filed per consumer batch
+ingest_visibility = 60      # seconds the consumer holds an ingest message
+ingest_lock = threading.Lock()
+bulk_chunk = 500            # feed rows filed per batch by file_complaints_bulk
+
+# review session, the next review is prefetched while a reviewer decides, see next_review_item
+review_prefetch = {'item': None, 'thread': None}
+review_lock = threading.Lock()
+review_stats = {'served': 0, 'prefetched': 0, 'expired': 0}
+
+# review order, the secrets 'review_order' picks 'fifo' (sqs order) or 'priority', see review_rank
+review_boost = {'objectionable': 3600}  # seconds a complaint type is moved ahead
+review_per_complaint = 300  # seconds a review is moved ahead for each further open complaint
+
+# near duplicate images, see review_key and add_content_hashes
+near_distance = 6           # bits two 64 bit image hashes may differ in and still be one image
+near_tree = None            # nearby.BKTree of the indexed hashes, built by get_near_tree
+
+# queue and database reconciliation, see reconcile
+reconcile_age = 900         # seconds an open complaint waits before it counts as stuck
+reconcile_seconds = 240     # time budget of one run from the command line
+reconcile_margin = 10       # seconds a scheduled run leaves of its lambda timeout, see reconcile_budget
+reconcile_batch = 500       # rows read per query
+reconcile_state = {'cursor': None}  # complaint_id the scan for unclaimed complaints resumes after
+sqs_retention = 4 * 86400   # the review queue's MessageRetentionPeriod, older messages are gone
+
+# request latency per route, see record_latency
+latency_window = 1000       # most recent durations kept per route
+latency_samples = {}        # route -> deque of seconds
+
+# request tracing, see set_tracing
+trace_enabled = False       # switched by set_tracing, CS_TRACE or the 'trace' secret
+trace_local = threading.local()
+trace_lock = threading.Lock()
+trace_originals = {}        # name -> process function, while tracing wraps it
+trace_max_spans = 500       # spans kept per request, the rest are only counted
+trace_sql_chars = 200       # statement text kept per sql span
+sql_fingerprints = {}       # statement -> (fingerprint, normalized text)
+trace_skip = set([          # cheap or per call helpers, not worth a span each
+    'set_tracing', 'traced', 'start_trace', 'trace_span', 'end_trace', 'sql_fingerprint',
+    'trace_before_sql', 'trace_after_sql', 'record_timing', 'record_latency', 'cache_count',
+    'content_key', 'gallery_key', 'JsonPretty', 'count_connect', 'get_secrets', 'get_db',
+    'get_metadata', 'get_table', 'get_client', 'get_cache', 'get_queue_url', 'record_type',
+    'first_record', 'next_cursor', 'group_key', 'flush_purges', 'get_purge_queues'
+])
+trace_log = logging.getLogger('cs.trace')  # one json line per request, no prefix
+trace_log.propagate = False
+trace_log.setLevel(logging.INFO)
+if not trace_log.handlers:
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_log.addHandler(handler)
+
+import_timing['globals'] = round(time.time() - import_mark, 4)
 
 
 # ------------------------------------------------------------------------------
@@ -84,336 +223,3180 @@ def JsonPretty(jsonData):
 
 
 # ------------------------------------------------------------------------------
-def put_sqsmessage(comp):
-    """ puts a complaint message in the sqs queue
-        in: complaint json
-        out: sqs message
-        return sqs message id
+def get_secrets(refresh=False):
+    """ returns the secrets (database and queue access), read on first use
+        and cached for secrets_ttl seconds. The CS_SECRETS environment
+        variable (json text) or CS_SECRETS_FILE (path to a json file) take
+        the place of the secrets.json object on s3, e.g. for local runs.
+        in: refresh, read the secrets again even if the cache is fresh
+        return secrets dict
     """
-    try:
-        sqs = session.resource('sqs')
-        queue = sqs.get_queue_by_name(QueueName=queue_name)
-        response = queue.send_message(MessageBody=json.dumps(comp))
-    except:
-        err("cannot send message to sqs")
-        return 'error'
+    cache = secrets_cache
+    if not refresh and cache['secrets'] != None and time.time() - cache['loaded'] < secrets_ttl:
+        return cache['secrets']
+
+    if os.environ.get('CS_SECRETS'):
+        gp = json.loads(os.environ['CS_SECRETS'])
+    elif os.environ.get('CS_SECRETS_FILE'):
+        with open(os.environ['CS_SECRETS_FILE']) as f: gp = json.load(f)
     else:
-        return response.get('MessageId')
+        gp_obj = get_client('s3').get_object(Bucket=secrets_bucket, Key=secrets_key)
+        gp = json.loads(gp_obj['Body'].read())
+
+    cache['secrets'] = gp
+    cache['loaded'] = time.time()
+    if 'trace' in gp and bool(gp['trace']) != trace_enabled: set_tracing(gp['trace'])
+
+    return gp
 
 
 # ------------------------------------------------------------------------------
-def get_sqsmessage():
-    """ gets a complaint message from the sqs queue
-        in: sqs message, sqs message id
-        return sqs message, sqs message id, sqs message receipt handle
+class TimedQueuePool(QueuePool):
+    """ QueuePool that records how long each checkout waited, how often the
+        pool was exhausted (every connection in use) and how often a checkout
+        timed out, in pool_stats.
     """
-    try: 
-        sqs = session.client('sqs')
-        response = sqs.receive_message(
-                                        QueueUrl=queue_url,
-                                        AttributeNames=['SentTimestamp'],
-                                        MaxNumberOfMessages=1,
-                                        MessageAttributeNames=['All'],
-                                        VisibilityTimeout=600 # ten minutes
-                                        #VisibilityTimeout=10 # ten seconds
-        )
-    except:
-        err("problem reading queue {}".format(pp['queue_name']))
-        return 'error', 'error', 'error'
-    else:
-        # handle message
-        if 'Messages' in response.keys():
-            message = response['Messages'][0]
-            return json.loads(message['Body']), message['MessageId'], message['ReceiptHandle']
-        else: 
-            return None, None, None
+    def _do_get(self):
+        start = time.time()
+        if self.checkedout() >= self.size() + self._max_overflow: pool_stats['exhausted'] += 1
+        try:
+            return QueuePool._do_get(self)
+        except sqlalchemy.exc.TimeoutError:
+            pool_stats['timeouts'] += 1
+            raise
+        finally:
+            wait = time.time() - start
+            pool_stats['checkouts'] += 1
+            pool_stats['wait_seconds'] += wait
+            pool_stats['wait_max'] = max(pool_stats['wait_max'], wait)
 
 
 # ------------------------------------------------------------------------------
-def delete_sqsmessage(sqs_handle):
-    """ deletes an sqs message from the sqs queue
-        in: sqs message id
-        out: deleted sqs message
-        return success
+def count_connect(dbapi_connection, connection_record):
+    """ pool connect event, counts new database connections
     """
-    try:
-        sqs = session.client('sqs')
-        response = sqs.delete_message(
-            QueueUrl=queue_url,
-            ReceiptHandle=sqs_handle
+    pool_stats['connects'] += 1
+
+
+# ------------------------------------------------------------------------------
+def get_db():
+    """ returns the database engine, created from the secrets on first use.
+        A database_url in the secrets (e.g. sqlite:///content_safety.db)
+        replaces the mysql server settings, and a 'pool' entry overrides
+        pool_config.
+        return sqlalchemy engine
+    """
+    global db, metadata
+    if db == None:
+        gp = get_secrets()
+        mysql = gp.get('database_url') or "mysql+pymysql://{user}:{password}@{server}/{database}".format(
+            user=gp['user'], 
+            password=gp['password'],
+            server=gp['server'],
+            database=gp['database']
         )
-    except: return False
-    else: return True
-    
-    
+        config = dict(pool_config, **gp.get('pool', {}))
+        if config['null']:
+            db = create_engine(mysql, echo=False, poolclass=NullPool)
+        elif mysql.startswith('sqlite'):
+            db = create_engine(mysql, echo=False, pool_pre_ping=config['pre_ping'])
+        else:
+            db = create_engine(mysql, echo=False,
+                poolclass=TimedQueuePool,
+                pool_size=config['size'],
+                max_overflow=config['overflow'],
+                pool_timeout=config['timeout'],
+                pool_recycle=config['recycle'],
+                pool_pre_ping=config['pre_ping']
+            )
+        sqlalchemy.event.listen(db, 'connect', count_connect)
+        sqlalchemy.event.listen(db, 'before_cursor_execute', trace_before_sql)
+        sqlalchemy.event.listen(db, 'after_cursor_execute', trace_after_sql)
+        metadata = MetaData(db)
+
+    return db
+
+
 # ------------------------------------------------------------------------------
-def update_content(comp):
-    """ updates content in the contents table
-        in: content json
-        out: updated complaint row
+def get_pool_stats():
+    """ connection pool metrics
+        return pool_stats with the average checkout wait and the pool status
     """
-    contents = Table('contents', metadata, autoload=True)
-    rs = contents.update().where(contents.c.content_id == comp['content_id']).values(comp)
-    rs.execute()
+    stats = dict(pool_stats)
+    stats['wait_average'] = stats['wait_seconds'] / stats['checkouts'] if stats['checkouts'] else 0.0
+    stats['status'] = get_db().pool.status()
+
+    return stats
 
 
 # ------------------------------------------------------------------------------
-def update_complaint(comp):
-    """ updates  in the complaints table
-        in: complaint json
-        out: updated complaint row
+def get_metadata():
+    """ returns the metadata bound to the database engine
+        return sqlalchemy metadata
     """
-    complaints = Table('complaints', metadata, autoload=True)
-    rs = complaints.update().where(complaints.c.complaint_id == comp['complaint_id']).values(comp)
-    rs.execute()
+    get_db()
+
+    return metadata
 
 
 # ------------------------------------------------------------------------------
-def put_complaint(comp):
-    """ puts a complaint in the complaints table
-        in: complaint json
-        out: new complaint row
-        return complaint_id
+def get_table(name):
+    """ returns a table from the table registry, the table is reflected from
+        the database only the first time it is asked for in this container.
+        Reflection runs under table_lock, otherwise a thread could be handed
+        a table, or a table pulled in by a foreign key, that another thread
+        is still reflecting. A table is registered once it is complete, so
+        the lookup of a registered table takes no lock.
+        in: table name
+        return sqlalchemy table
     """
-    complaints = Table('complaints', metadata, autoload=True)
-    rs = complaints.insert()
-    out = rs.execute(comp)
+    table = tables.get(name)
+    if table is not None:
+        table_stats['avoided'] += 1
+        return table
 
-    return out.lastrowid
+    with table_lock:
+        table = tables.get(name)
+        if table is None:
+            # a foreign key may already have pulled this table into the metadata
+            if name not in get_metadata().tables: table_stats['reflected'] += 1
+            table = Table(name, get_metadata(), autoload=True)
+            tables[name] = table
+
+    return table
 
 
 # ------------------------------------------------------------------------------
-def get_complaint(cid):
-    """ queries the content table and returns a single value
-        in: content_id
-        return content row
+def reflect_tables(refresh=False):
+    """ reflects every table in table_names into the table registry, called
+        by app.py to warm a lambda container at start and, with refresh, to
+        pick up a schema change
+        in: refresh, drop the registry and reflect again
+        out: table registry
+        return table registry
     """
-    complaint = None
-    complaints = Table('complaints', metadata, autoload=True)
-    rs = complaints.select().where(complaints.c.complaint_id == str(cid))
-    rss = rs.execute()
-    for row in rss: complaint = dict(row)
-    
-    return complaint
+    if refresh:
+        inf("refreshing table registry")
+        with table_lock:
+            tables.clear()
+            get_metadata().clear()
+
+    for name in table_names:
+        if name not in tables: get_table(name)
+
+    return tables
 
 
 # ------------------------------------------------------------------------------
-def get_content(cid):
-    """ queries the content table and returns a single value
-        in: content_id
-        return content row
+class Record(tuple):
+    """ Read only result row kept as a plain tuple. Columns are read by name
+        (row['url']), as attributes (row.url, which jinja2 uses) or by
+        position. The column names live on the class, one class per column
+        list (see record_type), so a row costs no more than its values.
+        Being immutable, a row can be shared by the cache and every caller.
     """
-    content = None
-    contents = Table('contents', metadata, autoload=True)
-    rs = contents.select().where(contents.c.content_id == str(cid))
-    rss = rs.execute()
-    for row in rss: content = dict(row)
-    
-    return content
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    # --------------------------------------------------------------------------
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try: key = self._index[key]
+            except KeyError: raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    # --------------------------------------------------------------------------
+    def __getattr__(self, name):
+        try: return tuple.__getitem__(self, self._index[name])
+        except KeyError: raise AttributeError(name)
+
+    # --------------------------------------------------------------------------
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return tuple.__getitem__(self, index) if index != None else default
+
+    # --------------------------------------------------------------------------
+    def keys(self):
+        return self._fields
+
+    # --------------------------------------------------------------------------
+    def items(self):
+        return zip(self._fields, self)
+
+    # --------------------------------------------------------------------------
+    def __repr__(self):
+        return 'Record({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in zip(self._fields, self)))
+
+    # --------------------------------------------------------------------------
+    def _asdict(self):
+        """ a dict copy for a caller that needs to change the row
+        """
+        return dict(zip(self._fields, self))
 
 
 # ------------------------------------------------------------------------------
-def get_complaints_for_content(cid):
-    """ queries the complaints table for all complaints about a single content
-        in: content id
-        return all complaints about that content
+def record_type(fields):
+    """ returns the Record class for a list of column names, made once per
+        container for each column list
+        in: column names
+        return Record subclass
     """
-    comp = []
-    complaints = Table('complaints', metadata, autoload=True)
-    rs = complaints.select().where(complaints.c.content_id == str(cid))
-    rss = rs.execute()
-    for row in rss: comp.append(dict(row))
-    
-    return comp
+    fields = tuple(fields)
+    cls = record_types.get(fields)
+    if cls == None:
+        index = dict((name, i) for i, name in enumerate(fields))
+        cls = record_types.setdefault(fields, type('Record', (Record,), {'__slots__': (), '_fields': fields, '_index': index}))
+
+    return cls
 
 
 # ------------------------------------------------------------------------------
-def get_reviewer_from_email(email):
-    """ queries the reviewers table for reviewer with this email
-        assumes a one to one mapping between reviewers and emails
-        in: email
-        return reviewer
+def iter_records(result):
+    """ streams the rows of a query result as records, one at a time
+        in: sqlalchemy result
+        return iterator of records
     """
-    reviewer = None
-    reviewers = Table('reviewers', metadata, autoload=True)
-    rs = reviewers.select().where(reviewers.c.email == email)
-    rss = rs.execute()
-    for row in rss: reviewer = dict(row)
-    
-    return reviewer
+    cls = record_type(result.keys())
+    for row in result: yield cls(row)
 
 
 # ------------------------------------------------------------------------------
-def get_pinner_from_email(email):
-    """ queries the pinners table for pinner with this email
-        assumes a one to one mapping between pinners and emails
-        in: email
-        return pinner
+def first_record(result):
+    """ the first row of a query result as a record, the rest are not read
+        in: sqlalchemy result
+        return record, None if there are no rows
     """
-    pinner = None
-    pinners = Table('pinners', metadata, autoload=True)
-    rs = pinners.select().where(pinners.c.email == email)
-    rss = rs.execute()
-    for row in rss: pinner = dict(row)
-    
-    return pinner
+    row = result.fetchone()
+    result.close()
+
+    return record_type(result.keys())(row) if row != None else None
 
 
 # ------------------------------------------------------------------------------
-def get_pinners_list():
-    """ queries the pinners table and returns the values
-        return pinners list
+class SQSBatch(object):
+    """ Buffers sqs sends (message bodies) or deletes (receipt handles) and
+        sends them with the batch api, ten entries per call. The buffer is
+        flushed when it is full, when its oldest entry has waited max_wait
+        seconds, or on demand. Entries that fail for a transient reason are
+        retried on their own, up to retries more times.
     """
-    pin = []
-    pinners = Table('pinners', metadata, autoload=True)
-    rs = pinners.select()
-    rss = rs.execute()
-    for row in rss: pin.append(dict(row))
-    
-    return pin
+    def __init__(self, action, max_size=10, max_wait=1.0, retries=2, queue=None):
+        self.action = action                        # 'send' or 'delete'
+        self.queue = queue                          # returns the queue url, the review queue if None
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.retries = retries
+        self.items = []
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'entries': 0, 'retried': 0, 'failed': 0}
+
+    # --------------------------------------------------------------------------
+    def success(self, entry):
+        """ result for an entry that went through
+        """
+        return entry.get('MessageId') if self.action == 'send' else True
+
+    # --------------------------------------------------------------------------
+    def failure(self):
+        """ result for an entry that did not go through
+        """
+        return 'error' if self.action == 'send' else False
+
+    # --------------------------------------------------------------------------
+    def due(self):
+        """ true when the buffer is full or its oldest entry waited too long
+        """
+        if not self.items: return False
+        return len(self.items) >= self.max_size or time.time() - self.oldest >= self.max_wait
+
+    # --------------------------------------------------------------------------
+    def add(self, item, flush=False, token=None):
+        """ buffers one entry, flushing if the buffer is due or flush is set
+            in: message body or receipt handle, flush, token handed back with
+                the entry's result so a caller can find its own entries
+            return list of (item, result, token) of the flush, empty if none
+        """
+        with self.lock:
+            if not self.items: self.oldest = time.time()
+            self.items.append((item, token))
+
+        if flush or self.due(): return self.flush()
+        return []
+
+    # --------------------------------------------------------------------------
+    def call(self, items):
+        """ one batch api call
+            in: up to ten items
+            return {entry id: successful entry}, {entry id: failed entry}
+        """
+        self.stats['calls'] += 1
+        self.stats['entries'] += len(items)
+        url = self.queue() if self.queue else get_queue_url()
+        if self.action == 'send':
+            entries = [{'Id': str(i), 'MessageBody': item} for i, item in enumerate(items)]
+            response = get_client('sqs').send_message_batch(QueueUrl=url, Entries=entries)
+        else:
+            entries = [{'Id': str(i), 'ReceiptHandle': item} for i, item in enumerate(items)]
+            response = get_client('sqs').delete_message_batch(QueueUrl=url, Entries=entries)
+
+        ok = dict((e['Id'], e) for e in response.get('Successful', []))
+        failed = dict((e['Id'], e) for e in response.get('Failed', []))
+        return ok, failed
+
+    # --------------------------------------------------------------------------
+    def flush(self):
+        """ sends everything in the buffer
+            return list of (item, result, token) in the order the items were
+                added, result is the message id or True on success, 'error'
+                or False on failure
+        """
+        with self.lock:
+            items, self.items = self.items, []
+
+        results = []
+        for start in range(0, len(items), 10):
+            chunk = items[start:start + 10]
+            done = {}
+            pending = list(range(len(chunk)))
+            for attempt in range(self.retries + 1):
+                try: ok, failed = self.call([chunk[i][0] for i in pending])
+                except:
+                    war("sqs {} batch call failed".format(self.action))
+                    ok, failed = {}, {}
+
+                retry = []
+                for j, i in enumerate(pending):
+                    if str(j) in ok: done[i] = self.success(ok[str(j)])
+                    elif failed.get(str(j), {}).get('SenderFault'): done[i] = self.failure()
+                    else: retry.append(i)
+                pending = retry
+                if not pending or attempt == self.retries: break
+
+                self.stats['retried'] += len(pending)
+                time.sleep(0.05 * 2 ** attempt)
+
+            for i in pending: done[i] = self.failure()
+            for i, (item, token) in enumerate(chunk):
+                if done[i] == self.failure(): self.stats['failed'] += 1
+                results.append((item, done[i], token))
+
+        return results
+
+
+sqs_sender = SQSBatch('send', max_wait=sqs_batch_wait)
+sqs_deleter = SQSBatch('delete', max_wait=sqs_batch_wait)
 
 
 # ------------------------------------------------------------------------------
-def get_reviewers_list():
-    """ queries the reviewers table and returns the values
-        return reviewers list
+def report_sqsbatch(results, action):
+    """ logs the entries of a batch flush that did not go through
+        in: list of (item, result, token), action for the log
+        return number of failures
     """
-    rev = []
-    reviewers = Table('reviewers', metadata, autoload=True)
-    rs = reviewers.select()
-    rss = rs.execute()
-    for row in rss: rev.append(dict(row))
-    
-    return rev
+    failures = [item for item, result, token in results if result in ('error', False)]
+    for item in failures: err("sqs {} failed for {}".format(action, item))
+
+    return len(failures)
 
 
 # ------------------------------------------------------------------------------
-def get_content_list():
-    """ queries the content table and returns the values
-        return content list
+def flush_sqs(force=False):
+    """ flushes the send and delete buffers that are due, or all of them
+        in: force, flush even if the buffers are not due
+        return number of entries that failed
     """
-    conts = []
-    contents = Table('contents', metadata, autoload=True)
-    rs = contents.select()
-    rss = rs.execute()
-    for row in rss: conts.append(dict(row))
-    
-    return conts
+    failed = 0
+    if force or sqs_sender.due(): failed += report_sqsbatch(sqs_sender.flush(), 'send')
+    if force or sqs_deleter.due(): failed += report_sqsbatch(sqs_deleter.flush(), 'delete')
+
+    return failed
 
 
 # ------------------------------------------------------------------------------
-def get_complaint_list():
-    """ queries the complaint table and returns the values
-        return complaint list
+def put_sqsmessages(comps, flush=True):
+    """ puts several complaint messages in the sqs queue with batch sends
+        in: list of complaint json, flush, send now instead of when due
+        out: sqs messages
+        return list of sqs message ids ('error' on failure, None if still
+            buffered), one per complaint
     """
-    conts = []
-    complaints = Table('complaints', metadata, autoload=True)
-    rs = complaints.select()
-    rss = rs.execute()
-    for row in rss: conts.append(dict(row))
-    
-    return conts
+    tokens = [object() for comp in comps]
+    results = []
+    for comp, token in zip(comps, tokens):
+        results += sqs_sender.add(json.dumps(comp, default=str), token=token)
+    if flush: results += sqs_sender.flush()
+
+    wanted = set(tokens)
+    mine = dict((token, result) for item, result, token in results if token in wanted)
+    report_sqsbatch([entry for entry in results if entry[2] not in mine], 'send')
+
+    return [mine.get(token) for token in tokens]
 
 
 # ------------------------------------------------------------------------------
-def file_complaint(redata):
-    """ handles a new complaint, creates complaint row, sends sqs message if 
-        complaint is unique
-        in: data from cs_submit page
-        out: complaint record, SQS message if necessary
-        return complaint_id
+def put_sqsmessage(comp, flush=True):
+    """ puts a complaint message in the sqs queue
+        in: complaint json, flush, send now instead of when due
+        out: sqs message
+        return sqs message id, 'error' on failure, None if still buffered
     """
-    sqsmessage = True
-    complaint = {}
-    
-    # create the complaint
-    complaint['complaint_timestamp'] = datetime.datetime.now()
-    complaint['complaint_type'] = 'objectionable'
-    complaint['process_status'] = 'complaint'
-    complaint['display_status'] = redata['display_status']
-    
-    pinner = get_pinner_from_email(redata['pinner'])
-    complaint['pinner_id'] = pinner['pinner_id']
-    
-    complaint['content_id'] = int(redata['content_id'])
+    sqs_id = put_sqsmessages([comp], flush)[0]
+    if sqs_id == 'error': err("cannot send message to sqs")
 
-    # check to see if this content is already in the queue for review
-    # if so, no sqs message is sent
-    # we could also search on near by images or image features
-    prior_complaints = get_complaints_for_content(complaint['content_id'])
-    if not prior_complaints == []: 
-        for p in prior_complaints:
-            if p['process_status'] == 'complaint':
-                sqsmessage = False
-    
-    # post the complaint to the table
-    complaint_id = put_complaint(complaint)
-    
-    # post the complain to the sqs queue
-    if sqsmessage:
-        complaint['complaint_timestamp'] = str(complaint['complaint_timestamp'])
-        complaint['complaint_id'] = complaint_id
-        sqs_id = put_sqsmessage(complaint)
-    
-    return complaint_id
+    return sqs_id
 
 
 # ------------------------------------------------------------------------------
-def review_complaint(redata):
-    """ resolves all complaints related to a given content,
-        changes display status if necessary
-        in: data from review pop page
-        out: update complaint record, update display status if necessary
-        return success
+class TimedClient(object):
+    """ Wraps a boto3 client, or a local stand in, and records the time of
+        every api call in aws_timing.
     """
-    # get data
-    complaint = get_complaint(redata['complaint_id'])
+    def __init__(self, service, client):
+        self.service = service
+        self.client = client
 
-    if complaint != None:
-        complaint_list = get_complaints_for_content(complaint['content_id'])
-        content = get_content(complaint['content_id'])
-        reviewer = get_reviewer_from_email(redata['reviewer'])
+    # --------------------------------------------------------------------------
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or name in ('meta', 'exceptions') or not callable(attr): return attr
 
-        # update data
-        timestamp = datetime.datetime.now()
-        for c in complaint_list:
-            c['review_timestamp'] = timestamp
-            c['reviewer_id'] = reviewer['reviewer_id']
-            c['process_status'] = 'done'
+        def timed(*args, **kwargs):
+            start = time.time()
+            try: return attr(*args, **kwargs)
+            finally:
+                seconds = time.time() - start
+                record_timing(self.service + '.' + name, seconds)
+                if trace_enabled: trace_span('aws', self.service + '.' + name, seconds, start)
 
-        # pull image from display if necessary
-        if redata['comp'] == 'Bad':
-            content['display_status'] = complaint['complaint_type']
-            update_content(content)
-    
-            for c in complaint_list:
-                c['display_status'] = complaint['complaint_type']
+        return timed
 
-        for c in complaint_list:
-            update_complaint(c)
 
-    # delete sqs message
-    success = delete_sqsmessage(redata['sqs_handle'])
+# ------------------------------------------------------------------------------
+def record_timing(key, seconds):
+    """ adds one call to the aws call timing
+        in: 'service.operation', duration in seconds
+        out: updated aws_timing
+    """
+    t = aws_timing.setdefault(key, {'calls': 0, 'seconds': 0.0, 'max': 0.0})
+    t['calls'] += 1
+    t['seconds'] += seconds
+    t['max'] = max(t['max'], seconds)
 
 
 # ------------------------------------------------------------------------------
-def reset_content():
-    """ changes the display_status value to 'good' for all content.
-        Essentially is starts the content table fresh. 
-        The complaints are untouched.
-        out: update all content records
+def record_latency(route, seconds):
+    """ keeps the duration of one request, the latest latency_window per route
+        in: route name, duration in seconds
+        out: updated latency_samples
     """
-    # get data
-    contents = get_content_list()
-    print(contents)
-    
-    for c in contents:
-        c['display_status'] = 'good'
-        update_content(c)
+    samples = latency_samples.get(route)
+    if samples == None:
+        samples = latency_samples.setdefault(route, collections.deque(maxlen=latency_window))
+    samples.append(seconds)
 
 
-# ------------------------------------------------------------------------
-if __name__ == '__main__':
-    """ put module tests and development experiments here
+# ------------------------------------------------------------------------------
+def get_latency(route):
+    """ latency percentiles of the recent requests to a route, in milliseconds
+        in: route name
+        return dict with count, p50, p95, p99 and max
+    """
+    samples = sorted(latency_samples.get(route, ()))
+    stats = {'count': len(samples)}
+    for name, q in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99), ('max', 1.0)):
+        stats[name] = round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3) if samples else None
+
+    return stats
+
+
+# ------------------------------------------------------------------------------
+def set_tracing(on):
+    """ Switches request tracing on or off at runtime. On, every process
+        function (less trace_skip) is replaced by a wrapper that records a
+        span when it runs inside a traced request; off, the original
+        functions are put back, and the sql, aws and render hooks cost a
+        flag test.
+        in: True or False
+        return previous setting
     """
-    pass
+    global trace_enabled
+    with trace_lock:
+        previous = trace_enabled
+        module = globals()
+        if on and not trace_originals:
+            for name, func in list(module.items()):
+                if name in trace_skip or not isfunction(func) or func.__module__ != __name__: continue
+                if isgeneratorfunction(func): continue
+                trace_originals[name] = func
+                module[name] = traced(name, func)
+        elif not on and trace_originals:
+            module.update(trace_originals)
+            trace_originals.clear()
+        trace_enabled = bool(on)
+
+    return previous
+
+
+# ------------------------------------------------------------------------------
+def traced(name, func):
+    """ wraps a process function to record a span per call in the current
+        trace, nested calls are one level deeper
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        trace = getattr(trace_local, 'trace', None)
+        if trace == None: return func(*args, **kwargs)
+        trace['depth'] += 1
+        start = time.time()
+        try: return func(*args, **kwargs)
+        finally:
+            trace['depth'] -= 1
+            trace_span('process', name, time.time() - start, start)
+
+    return wrapper
+
+
+# ------------------------------------------------------------------------------
+def start_trace(name, **fields):
+    """ starts the trace of a request on this thread, when tracing is on
+        in: route or event name, fields to add to the record
+    """
+    if not trace_enabled: return
+    trace_local.trace = dict(fields, trace_id=uuid.uuid4().hex[:16], name=name,
+                             start=time.time(), depth=0, spans=[], dropped=0)
+
+
+# ------------------------------------------------------------------------------
+def trace_span(kind, name, seconds, start=None, **fields):
+    """ adds one timed span to the current trace, if there is one
+        in: 'process', 'sql', 'aws' or 'render', name, duration in seconds,
+            start epoch, fields to add to the span
+    """
+    trace = getattr(trace_local, 'trace', None)
+    if trace == None: return
+    if len(trace['spans']) >= trace_max_spans:
+        trace['dropped'] += 1
+        return
+
+    if start == None: start = time.time() - seconds
+    span = {'kind': kind, 'name': name, 'at_ms': round((start - trace['start']) * 1000, 3),
+            'ms': round(seconds * 1000, 3), 'depth': trace['depth']}
+    span.update(fields)
+    trace['spans'].append(span)
+
+
+# ------------------------------------------------------------------------------
+def end_trace(**fields):
+    """ ends the trace of this thread's request and logs it as one json
+        line on the cs.trace logger, so CloudWatch Logs Insights can query
+        the fields. The totals add up the sql, aws and render spans and the
+        outermost process spans.
+        in: fields to add to the record, e.g. status
+        return trace record, None when there was no trace
+    """
+    trace = getattr(trace_local, 'trace', None)
+    trace_local.trace = None
+    if trace == None: return None
+
+    seconds = time.time() - trace.pop('start')
+    trace.pop('depth')
+    totals = {}
+    for span in trace['spans']:
+        if span['kind'] == 'process' and span['depth'] > 0: continue
+        total = totals.setdefault(span['kind'], {'count': 0, 'ms': 0.0})
+        total['count'] += 1
+        total['ms'] = round(total['ms'] + span['ms'], 3)
+
+    record = dict(trace, type='trace', ms=round(seconds * 1000, 3), totals=totals, **fields)
+    trace_log.info(json.dumps(record, default=str))
+
+    return record
+
+
+# ------------------------------------------------------------------------------
+def sql_fingerprint(statement):
+    """ the shape of a statement: literals become ?, runs of value lists
+        and in lists collapse, so the same query with other parameters or
+        row counts has the same fingerprint
+        in: statement text
+        return fingerprint, normalized text
+    """
+    found = sql_fingerprints.get(statement)
+    if found != None: return found
+
+    text = ' '.join(statement.split())
+    text = re.sub(r"'(?:[^']|'')*'", '?', text)
+    text = re.sub(r'%\(\w+\)s|%s|:\w+|\b\d+(\.\d+)?\b', '?', text)
+    text = re.sub(r'\?(, \?)+', '?, ...', text)
+    text = re.sub(r'\((\?, \.\.\.|\?)\)(, \((\?, \.\.\.|\?)\))+', r'(\1), ...', text)
+    found = (hashlib.md5(text.encode()).hexdigest()[:12], text)
+    if len(sql_fingerprints) < 1000: sql_fingerprints[statement] = found
+
+    return found
+
+
+# ------------------------------------------------------------------------------
+def trace_before_sql(conn, cursor, statement, parameters, context, executemany):
+    """ engine event, notes when a statement starts
+    """
+    if trace_enabled: conn.info['trace_start'] = time.time()
+
+
+# ------------------------------------------------------------------------------
+def trace_after_sql(conn, cursor, statement, parameters, context, executemany):
+    """ engine event, records the statement as a span with its fingerprint
+        and the rows it returned or changed (-1 when the driver cannot tell)
+    """
+    start = conn.info.pop('trace_start', None)
+    if not trace_enabled or start == None: return
+    fingerprint, text = sql_fingerprint(statement)
+    trace_span('sql', fingerprint, time.time() - start, start, rows=cursor.rowcount,
+               many=executemany, statement=text[:trace_sql_chars])
+
+
+# ------------------------------------------------------------------------------
+def get_client(service):
+    """ returns the shared client for an aws service, the client and its
+        connection pool are created once per container
+        in: service name, e.g. 'sqs' or 's3'
+        return timed client
+    """
+    client = aws_clients.get(service)
+    if client == None:
+        client = TimedClient(service, session.client(service, config=aws_config))
+        aws_clients[service] = client
+
+    return client
+
+
+# ------------------------------------------------------------------------------
+def set_client(service, client):
+    """ replaces the shared client for a service, e.g. with a local stand in
+        in: service name, client
+        return timed client
+    """
+    aws_clients[service] = TimedClient(service, client)
+
+    return aws_clients[service]
+
+
+# ------------------------------------------------------------------------------
+def get_queue_url():
+    """ returns the review queue url, resolved from the queue name only once
+        return queue url
+    """
+    global queue_url
+    if queue_url == None:
+        gp = get_secrets()
+        queue_url = gp.get('queue_url') or get_client('sqs').get_queue_url(QueueName=gp['queue_name'])['QueueUrl']
+
+    return queue_url
+
+
+# ------------------------------------------------------------------------------
+def receive_sqsbatch():
+    """ leases up to sqs_batch_size messages from the queue into the local
+        buffer. The lease is short (sqs_hold) so messages this container
+        does not hand out go back to the other reviewers quickly.
+        out: buffered messages
+        return number of messages received
+    """
+    response = get_client('sqs').receive_message(
+        QueueUrl=get_queue_url(),
+        AttributeNames=['SentTimestamp'],
+        MaxNumberOfMessages=sqs_batch_size,
+        MessageAttributeNames=['All'],
+        VisibilityTimeout=sqs_hold
+    )
+    messages = response.get('Messages', [])
+    leased = time.time()
+    for message in messages: sqs_buffer.append({'message': message, 'leased': leased})
+    sqs_stats['receives'] += 1
+    sqs_stats['received'] += len(messages)
+
+    return len(messages)
+
+
+# ------------------------------------------------------------------------------
+def release_sqsbuffer():
+    """ gives every buffered message back to the queue right away by
+        setting its visibility timeout to zero
+        out: emptied buffer
+        return number of messages released
+    """
+    released = 0
+    with sqs_lock:
+        while sqs_buffer:
+            batch = [sqs_buffer.popleft() for i in range(min(10, len(sqs_buffer)))]
+            entries = [{'Id': str(i), 'ReceiptHandle': e['message']['ReceiptHandle'], 'VisibilityTimeout': 0}
+                       for i, e in enumerate(batch)]
+            try:
+                response = get_client('sqs').change_message_visibility_batch(QueueUrl=get_queue_url(), Entries=entries)
+            except:
+                war("cannot release buffered messages, they return after {} s".format(sqs_hold))
+            else:
+                released += len(response.get('Successful', []))
+    sqs_stats['released'] += released
+
+    return released
+
+
+# ------------------------------------------------------------------------------
+def get_sqsmessage(lease=None):
+    """ gets a complaint message from the sqs queue. Messages are received in
+        batches and handed out one at a time from the container's buffer,
+        each message's lease is extended to sqs_visibility when it is handed out
+        in: lease, seconds to extend the lease to instead of sqs_visibility
+        return sqs message, sqs message id, sqs message receipt handle
+    """
+    flush_sqs()
+
+    try:
+        with sqs_lock:
+            while True:
+                # drop messages whose lease ran out, the queue may have given them to someone else
+                while sqs_buffer and time.time() - sqs_buffer[0]['leased'] > sqs_hold - 5:
+                    sqs_buffer.popleft()
+                    sqs_stats['expired'] += 1
+
+                if not sqs_buffer:
+                    if receive_sqsbatch() == 0: return None, None, None
+                    continue
+
+                # the reviewer gets the full visibility timeout
+                message = sqs_buffer.popleft()['message']
+                try:
+                    get_client('sqs').change_message_visibility(
+                        QueueUrl=get_queue_url(),
+                        ReceiptHandle=message['ReceiptHandle'],
+                        VisibilityTimeout=lease or sqs_visibility
+                    )
+                except ClientError:
+                    war("lease lost for message {}".format(message['MessageId']))
+                    sqs_stats['expired'] += 1
+                    continue
+
+                sqs_stats['served'] += 1
+                return json.loads(message['Body']), message['MessageId'], message['ReceiptHandle']
+    except:
+        err("problem reading queue {}".format(queue_url))
+        return 'error', 'error', 'error'
+
+
+# ------------------------------------------------------------------------------
+def delete_sqsmessages(sqs_handles, flush=True):
+    """ deletes several sqs messages from the sqs queue with batch deletes
+        in: list of sqs receipt handles, flush, delete now instead of when due
+        out: deleted sqs messages
+        return list of success (None if still buffered), one per handle
+    """
+    tokens = [object() for sqs_handle in sqs_handles]
+    results = []
+    for sqs_handle, token in zip(sqs_handles, tokens):
+        results += sqs_deleter.add(sqs_handle, token=token)
+    if flush: results += sqs_deleter.flush()
+
+    wanted = set(tokens)
+    mine = dict((token, result) for item, result, token in results if token in wanted)
+    report_sqsbatch([entry for entry in results if entry[2] not in mine], 'delete')
+
+    return [mine.get(token) for token in tokens]
+
+
+# ------------------------------------------------------------------------------
+def delete_sqsmessage(sqs_handle, flush=True):
+    """ deletes an sqs message from the sqs queue
+        in: sqs receipt handle, flush, delete now instead of when due
+        out: deleted sqs message
+        return success, None if still buffered
+    """
+    return delete_sqsmessages([sqs_handle], flush)[0]
+    
+    
+# ------------------------------------------------------------------------------
+class LRUCache(object):
+    """ In-memory cache backend for one container, bounded to max_size
+        entries with the least recently used dropped first. Each entry
+        expires after its ttl.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()    # key -> (value, expires at)
+        self.hashes = {}                            # name -> [{field: value}, expires at]
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None: return None
+            if entry[1] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    # --------------------------------------------------------------------------
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size: self.entries.popitem(last=False)
+
+    # --------------------------------------------------------------------------
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys: self.entries.pop(key, None)
+
+    # --------------------------------------------------------------------------
+    def hash(self, name):
+        """ the fields of a live hash, None if there is none
+        """
+        entry = self.hashes.get(name)
+        if entry != None and entry[1] <= time.time():
+            del self.hashes[name]
+            entry = None
+        return entry
+
+    # --------------------------------------------------------------------------
+    def hset(self, name, field, value, ttl):
+        """ sets one field of a hash and moves the hash's expiry to ttl
+        """
+        with self.lock:
+            entry = self.hash(name) or self.hashes.setdefault(name, [{}, 0])
+            entry[0][field] = value
+            entry[1] = time.time() + ttl
+
+    # --------------------------------------------------------------------------
+    def hget(self, name, field):
+        with self.lock:
+            entry = self.hash(name)
+            return entry[0].get(field) if entry != None else None
+
+    # --------------------------------------------------------------------------
+    def hgetall(self, name):
+        with self.lock:
+            entry = self.hash(name)
+            return dict(entry[0]) if entry != None else {}
+
+    # --------------------------------------------------------------------------
+    def hdel(self, name, *fields):
+        with self.lock:
+            entry = self.hash(name)
+            if entry != None:
+                for field in fields: entry[0].pop(field, None)
+
+    # --------------------------------------------------------------------------
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hashes.clear()
+
+
+# ------------------------------------------------------------------------------
+class RedisCache(object):
+    """ Cache backend on a redis compatible client (redis.Redis, or
+        localredis.LocalRedis for local runs), shared by every container
+        that points at the same server. Values are stored as json.
+    """
+    def __init__(self, client, prefix='cs:'):
+        self.client = client
+        self.prefix = prefix
+
+    # --------------------------------------------------------------------------
+    def pack(self, value):
+        """ records keep their column names in the json
+        """
+        if isinstance(value, Record): return {'_fields': list(value._fields), '_values': list(value)}
+        if isinstance(value, list): return [self.pack(v) for v in value]
+        return value
+
+    # --------------------------------------------------------------------------
+    def unpack(self, value):
+        if isinstance(value, dict) and '_fields' in value: return record_type(value['_fields'])(value['_values'])
+        if isinstance(value, list): return [self.unpack(v) for v in value]
+        return value
+
+    # --------------------------------------------------------------------------
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return self.unpack(json.loads(value)) if value != None else None
+
+    # --------------------------------------------------------------------------
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(self.pack(value), default=str), ex=ttl)
+
+    # --------------------------------------------------------------------------
+    def delete(self, *keys):
+        if keys: self.client.delete(*[self.prefix + key for key in keys])
+
+    # --------------------------------------------------------------------------
+    def hset(self, name, field, value, ttl):
+        """ sets one field of a hash, atomic on the server, and moves the
+            hash's expiry to ttl
+        """
+        self.client.hset(self.prefix + name, field, json.dumps(value, default=str))
+        self.client.expire(self.prefix + name, ttl)
+
+    # --------------------------------------------------------------------------
+    def hget(self, name, field):
+        value = self.client.hget(self.prefix + name, field)
+        return json.loads(value) if value != None else None
+
+    # --------------------------------------------------------------------------
+    def hgetall(self, name):
+        fields = self.client.hgetall(self.prefix + name)
+        return dict((k.decode() if isinstance(k, bytes) else k, json.loads(v)) for k, v in fields.items())
+
+    # --------------------------------------------------------------------------
+    def hdel(self, name, *fields):
+        if fields: self.client.hdel(self.prefix + name, *fields)
+
+    # --------------------------------------------------------------------------
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys: self.client.delete(*keys)
+
+
+# ------------------------------------------------------------------------------
+def get_cache():
+    """ returns the cache backend, an in-memory LRUCache unless set_cache
+        installed another
+        return cache backend
+    """
+    global cache
+    if cache == None: cache = LRUCache(cache_size)
+
+    return cache
+
+
+# ------------------------------------------------------------------------------
+def set_cache(backend):
+    """ replaces the cache backend, e.g. with RedisCache(redis.Redis(...))
+        in: cache backend
+        return cache backend
+    """
+    global cache
+    cache = backend
+
+    return cache
+
+
+# ------------------------------------------------------------------------------
+def cache_count(kind, what):
+    """ adds one to a cache statistic
+        in: kind of entry (the key prefix), statistic name
+    """
+    stats = cache_stats.setdefault(kind, {'hits': 0, 'misses': 0, 'invalidated': 0, 'errors': 0})
+    stats[what] += 1
+
+
+# ------------------------------------------------------------------------------
+def cached(key, load):
+    """ read through lookup, returns the cached value or loads it and caches
+        it. Backend failures fall back to the database. Rows are read only
+        records shared with the cache, only lists and dicts are copied so a
+        caller changing its result does not change the cache.
+        in: cache key 'kind:id', function loading the value
+        return value
+    """
+    kind = key.split(':')[0]
+    try: value = get_cache().get(key)
+    except:
+        war("cache get failed for {}".format(key))
+        cache_count(kind, 'errors')
+        value = None
+
+    if value != None:
+        cache_count(kind, 'hits')
+    else:
+        cache_count(kind, 'misses')
+        value = load()
+        if value != None:
+            try: get_cache().set(key, value, cache_ttl[kind])
+            except:
+                war("cache set failed for {}".format(key))
+                cache_count(kind, 'errors')
+
+    if isinstance(value, list): return list(value)
+    if isinstance(value, dict): return dict(value)
+    return value
+
+
+# ------------------------------------------------------------------------------
+def invalidate(*keys):
+    """ drops entries from the cache after the rows behind them changed
+        in: cache keys
+    """
+    if not keys: return
+    try: get_cache().delete(*keys)
+    except: err("cache invalidation failed for {}".format(keys))
+    for key in keys: cache_count(key.split(':')[0], 'invalidated')
+
+
+# ------------------------------------------------------------------------------
+def content_key(cid):
+    """ cache key of a content row
+        in: content_id
+        return key
+    """
+    return 'content:{}'.format(int(cid))
+
+
+# ------------------------------------------------------------------------------
+def group_key(cid):
+    """ cache key of a content's near duplicate group
+        in: content_id
+        return key
+    """
+    return 'group:{}'.format(int(cid))
+
+
+# ------------------------------------------------------------------------------
+def gallery_key(cursor, limit):
+    """ cache key of a rendered pinner gallery page
+        in: cursor, limit
+        return key
+    """
+    return 'gallery:{}:{}'.format(cursor, limit)
+
+
+# ------------------------------------------------------------------------------
+def get_gallery_page(cursor, limit, render):
+    """ returns a rendered pinner gallery page from the page cache, or renders
+        and caches it. Each cached page is indexed with the content_id range
+        it covers so invalidate_gallery only drops, and the next request only
+        rebuilds, the pages a moderation decision touched. Only the pages a
+        pinner reaches by following the next links at the default page size
+        are cached, the first page and the pages whose cursor ends a cached
+        page, so the pages and the index are bounded by the gallery and not
+        by the cursors clients send. The index is a hash written one field
+        at a time, so containers sharing a redis cache do not overwrite each
+        other's entries.
+        in: cursor, limit, render function (contents, next cursor) -> html
+        return page dict with body, etag, modified (epoch seconds)
+    """
+    key = gallery_key(int(cursor or 0), limit)
+    cacheable = limit == page_limit
+    page = None
+    try:
+        backend = get_cache()
+        if cacheable: page = backend.get(key)
+        if page == None and cacheable and cursor:
+            cacheable = backend.hget('gallery:bounds', str(int(cursor))) != None
+    except:
+        war("cache get failed for {}".format(key))
+        cacheable = False
+
+    if page != None:
+        cache_count('gallery', 'hits')
+        return page
+
+    cache_count('gallery', 'misses')
+    contents = get_content_list(cursor, limit, display_status='good')
+    cursor_next = next_cursor(contents, 'content_id', limit)
+    body = render(contents, cursor_next)
+    page = {
+        'body': body,
+        'etag': '"{}"'.format(hashlib.md5(body.encode()).hexdigest()),
+        'modified': int(time.time()),
+        'first': int(cursor or 0),          # page holds content_ids > first
+        'last': cursor_next                 # and <= last, None for the last page
+    }
+    if not cacheable: return page
+
+    try:
+        backend.set(key, page, gallery_ttl)
+        backend.hset('gallery:index', key, [page['first'], page['last']], gallery_ttl)
+        if cursor_next != None: backend.hset('gallery:bounds', str(cursor_next), key, gallery_ttl)
+    except: war("cache set failed for {}".format(key))
+
+    return page
+
+
+# ------------------------------------------------------------------------------
+def invalidate_gallery(content_ids):
+    """ drops the cached gallery pages whose content_id range holds any of
+        the given contents, called when their display status changes
+        in: content ids
+        return number of pages dropped
+    """
+    ids = sorted(int(cid) for cid in content_ids)
+    if not ids: return 0
+
+    try:
+        backend = get_cache()
+        stale = []
+        for key, (first, last) in backend.hgetall('gallery:index').items():
+            i = bisect.bisect_right(ids, first)
+            if i < len(ids) and (last == None or ids[i] <= last): stale.append(key)
+
+        if stale:
+            backend.delete(*stale)
+            backend.hdel('gallery:index', *stale)
+    except:
+        err("gallery invalidation failed for {} contents".format(len(ids)))
+        return 0
+
+    for key in stale: cache_count('gallery', 'invalidated')
+
+    return len(stale)
+
+
+# ------------------------------------------------------------------------------
+class CloudFrontPurge(object):
+    """ Purge backend for a CloudFront distribution in front of the images
+        and pages: one invalidation for the url paths of a batch of
+        takedowns, plus the paths of the pages that show them. CloudFront
+        bills invalidation paths and keeps at most 3000 in progress, so
+        takedowns are coalesced for wait seconds and an invalidation is
+        created at most every interval seconds. The client is
+        get_client('cloudfront'), localcdn.LocalCloudFront for local runs.
+    """
+    name = 'cdn'
+    stored = True           # queued in pending_purges, see StoredPurgeQueue
+
+    def __init__(self, distribution_id, pages=(), wait=None, interval=None, max_items=None):
+        self.distribution_id = distribution_id
+        self.pages = list(pages)            # e.g. ['/pinner*'], the gallery pages
+        self.wait = purge_wait if wait == None else wait
+        self.interval = purge_interval if interval == None else interval
+        self.max_items = max_items or purge_max
+
+    # --------------------------------------------------------------------------
+    def paths(self, takedowns):
+        """ the distinct paths to invalidate for a batch of takedowns
+        """
+        paths = set(self.pages)
+        for cid, url in takedowns:
+            path = urllib.parse.urlparse(url or '').path
+            if path: paths.add('/' + path.lstrip('/'))
+
+        return sorted(paths)
+
+    # --------------------------------------------------------------------------
+    def purge(self, takedowns):
+        """ in: list of (content_id, url)
+            return invalidation id
+        """
+        paths = self.paths(takedowns)
+        batch = {
+            'Paths': {'Quantity': len(paths), 'Items': paths},
+            'CallerReference': 'cs-{}'.format(uuid.uuid4().hex)
+        }
+        response = get_client('cloudfront').create_invalidation(
+            DistributionId=self.distribution_id, InvalidationBatch=batch)
+
+        return response['Invalidation']['Id']
+
+
+# ------------------------------------------------------------------------------
+class PurgeQueue(object):
+    """ Coalesces takedowns for one purge backend in memory, a content taken
+        down again before its purge went out is purged once. The queue is
+        due when it holds the backend's max_items takedowns or its oldest
+        has waited the backend's wait, and it calls the backend at most
+        every interval seconds. Takedowns whose purge fails stay queued for
+        the next flush. The seconds from a decision to its purge are kept as
+        the latency of 'purge.<backend name>'. In memory is right for a
+        backend that belongs to the container that decided.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.items = collections.OrderedDict()      # content_id -> (url, decided at)
+        self.last_call = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'queued': 0, 'coalesced': 0, 'purged': 0, 'calls': 0, 'failed': 0}
+
+    # --------------------------------------------------------------------------
+    def add(self, takedowns, decided):
+        """ queues takedowns
+            in: list of (content_id, url), decision time (epoch seconds)
+        """
+        with self.lock:
+            for cid, url in takedowns:
+                if cid in self.items:
+                    self.stats['coalesced'] += 1
+                else:
+                    self.items[cid] = (url, decided)
+                    self.stats['queued'] += 1
+
+    # --------------------------------------------------------------------------
+    def waiting(self):
+        """ number of takedowns waiting for their purge
+        """
+        return len(self.items)
+
+    # --------------------------------------------------------------------------
+    def oldest(self):
+        """ up to max_items of the oldest takedowns
+            return list of (content_id, url, decided at epoch seconds)
+        """
+        return [(cid, url, decided) for cid, (url, decided) in list(self.items.items())[:self.backend.max_items]]
+
+    # --------------------------------------------------------------------------
+    def remove(self, batch):
+        """ drops purged takedowns from the queue
+        """
+        for cid, url, decided in batch: self.items.pop(cid, None)
+
+    # --------------------------------------------------------------------------
+    def due(self, force=False):
+        """ the takedowns to purge now, none while the queue may wait for
+            more or the rate limit holds
+            in: force, do not wait for more takedowns, the rate limit holds
+            return list of (content_id, url, decided at)
+        """
+        now = time.time()
+        if now - self.last_call < self.backend.interval: return []
+        batch = self.oldest()
+        if not batch: return []
+        if force or len(batch) >= self.backend.max_items or now - batch[0][2] >= self.backend.wait: return batch
+
+        return []
+
+    # --------------------------------------------------------------------------
+    def flush(self, force=False):
+        """ calls the backend with max_items takedowns at a time while the
+            queue is due
+            in: force, do not wait for more takedowns
+            return number of takedowns purged
+        """
+        purged = 0
+        while True:
+            with self.lock:
+                batch = self.due(force)
+                if not batch: return purged
+                self.last_call = time.time()
+
+            self.stats['calls'] += 1
+            try: self.backend.purge([(cid, url) for cid, url, decided in batch])
+            except:
+                err("{} purge of {} takedowns failed".format(self.backend.name, len(batch)))
+                self.stats['failed'] += 1
+                return purged
+
+            done = time.time()
+            with self.lock: self.remove(batch)
+            for cid, url, decided in batch: record_latency('purge.' + self.backend.name, done - decided)
+            self.stats['purged'] += len(batch)
+            purged += len(batch)
+
+
+# ------------------------------------------------------------------------------
+class StoredPurgeQueue(PurgeQueue):
+    """ PurgeQueue kept in the pending_purges table, for backends that are
+        shared by every container, like the cdn. A takedown waiting for the
+        rate limit survives the container that decided it, and any
+        container or the scheduled job sends it. The primary key coalesces
+        a content taken down twice. A container only reads the table after
+        it queued takedowns itself, or when forced, so requests without a
+        decision cost no query. Takedowns the table did not take are kept
+        in memory and written again on the next flush. The rate limit is
+        kept per container.
+    """
+    def __init__(self, backend):
+        PurgeQueue.__init__(self, backend)
+        self.pending = False                        # this container queued takedowns not seen purged
+        self.unsaved = []                           # pending_purges rows not written yet
+
+    # --------------------------------------------------------------------------
+    def add(self, takedowns, decided):
+        stamp = datetime.datetime.fromtimestamp(decided)
+        urls = collections.OrderedDict()
+        for cid, url in takedowns: urls.setdefault(int(cid), url)
+        self.stats['coalesced'] += len(takedowns) - len(urls)
+
+        with self.lock:
+            self.unsaved += [{'backend': self.backend.name, 'content_id': cid, 'url': url, 'decided_at': stamp}
+                             for cid, url in urls.items()]
+            self.save()
+
+    # --------------------------------------------------------------------------
+    def save(self):
+        """ writes the unsaved takedowns to pending_purges, called with the
+            lock held. On failure they stay unsaved for the next flush.
+        """
+        if not self.unsaved: return
+
+        try: queued = max(0, get_db().execute(insert_ignore(get_table('pending_purges')), self.unsaved).rowcount)
+        except:
+            err("cannot queue {} {} takedowns, kept for the next flush".format(len(self.unsaved), self.backend.name))
+            return
+
+        self.stats['queued'] += queued
+        self.stats['coalesced'] += len(self.unsaved) - queued
+        self.unsaved = []
+        self.pending = True
+
+    # --------------------------------------------------------------------------
+    def waiting(self):
+        purges = get_table('pending_purges')
+        rs = select([func.count()]).where(purges.c.backend == self.backend.name)
+
+        return rs.scalar()
+
+    # --------------------------------------------------------------------------
+    def oldest(self):
+        purges = get_table('pending_purges')
+        rs = select([purges.c.content_id, purges.c.url, purges.c.decided_at]).\
+            where(purges.c.backend == self.backend.name).\
+            order_by(purges.c.decided_at, purges.c.content_id).limit(self.backend.max_items)
+        batch = [(row[0], row[1], row[2].timestamp()) for row in rs.execute()]
+        if not batch: self.pending = False
+
+        return batch
+
+    # --------------------------------------------------------------------------
+    def remove(self, batch):
+        purges = get_table('pending_purges')
+        rs = purges.delete().where(and_(purges.c.backend == self.backend.name,
+            purges.c.content_id.in_([cid for cid, url, decided in batch])))
+        rs.execute()
+
+    # --------------------------------------------------------------------------
+    def due(self, force=False):
+        self.save()
+        if not (force or self.pending): return []
+
+        return PurgeQueue.due(self, force)
+
+
+# ------------------------------------------------------------------------------
+def get_purge_queues():
+    """ the purge queues of the takedown backends, built on first use: a
+        cloudfront distribution when the secrets name one
+        (cdn_distribution_id, with cdn_page_paths for the paths of the pages
+        that show the images), none otherwise
+        return list of PurgeQueue
+    """
+    global purge_queues
+    if purge_queues == None:
+        backends = []
+        secrets = get_secrets()
+        if secrets.get('cdn_distribution_id'):
+            backends.append(CloudFrontPurge(secrets['cdn_distribution_id'], secrets.get('cdn_page_paths', ())))
+        purge_queues = [purge_queue(backend) for backend in backends]
+
+    return purge_queues
+
+
+# ------------------------------------------------------------------------------
+def purge_queue(backend):
+    """ the queue for a purge backend, in pending_purges for a backend that
+        is shared by the containers (stored = True), otherwise in memory
+        in: backend
+        return PurgeQueue
+    """
+    return StoredPurgeQueue(backend) if getattr(backend, 'stored', False) else PurgeQueue(backend)
+
+
+# ------------------------------------------------------------------------------
+def set_purge_backends(backends):
+    """ replaces the purge backends, e.g. to add another cdn. Takedowns
+        still queued in memory for the old backends are dropped. The app's
+        caches are not a backend, review_complaint drops their entries
+        itself so no choice of backends leaves a takedown cached.
+        in: list of backends
+        return list of PurgeQueue
+    """
+    global purge_queues
+    purge_queues = [purge_queue(backend) for backend in backends]
+
+    return purge_queues
+
+
+# ------------------------------------------------------------------------------
+def purge_takedowns(takedowns):
+    """ propagates a moderation decision beyond the app's caches: queues
+        the contents taken down with every purge backend and purges those
+        that are due, the cdn coalesced and rate limited. The decision is
+        already saved, so a failing backend is logged and its takedowns
+        are left for the next flush instead of failing the request.
+        in: list of (content_id, url)
+        return dict backend name -> takedowns purged now
+    """
+    decided = time.time()
+    purged = {}
+    for queue in get_purge_queues():
+        purged[queue.backend.name] = 0
+        try:
+            queue.add(takedowns, decided)
+            purged[queue.backend.name] = queue.flush()
+        except:
+            err("{} purge of {} takedowns failed, left for the next flush".format(queue.backend.name, len(takedowns)))
+
+    return purged
+
+
+# ------------------------------------------------------------------------------
+def flush_purges(force=False):
+    """ purges the queued takedowns that are due, after each request and,
+        forced, from the scheduled job, which sends the stored takedowns
+        that the deciding container left waiting
+        in: force, do not wait for more takedowns
+        return dict backend name -> takedowns purged, errors are logged and
+            the takedowns left queued
+    """
+    purged = {}
+    try: queues = get_purge_queues() if force else purge_queues or []
+    except:
+        err("cannot build the purge queues")
+        return purged
+
+    for queue in queues:
+        purged[queue.backend.name] = 0
+        try: purged[queue.backend.name] = queue.flush(force)
+        except: err("{} purge flush failed, takedowns left queued".format(queue.backend.name))
+
+    return purged
+
+
+# ------------------------------------------------------------------------------
+def get_purge_stats():
+    """ takedown purge statistics per backend, with the waiting takedowns
+        and the time to purge percentiles in milliseconds
+        return dict backend name -> stats
+    """
+    stats = {}
+    for queue in purge_queues or []:
+        name = queue.backend.name
+        stats[name] = dict(queue.stats, waiting=queue.waiting(), time_to_purge=get_latency('purge.' + name))
+
+    return stats
+
+
+# ------------------------------------------------------------------------------
+def update_content(comp):
+    """ updates content in the contents table
+        in: content json
+        out: updated complaint row
+    """
+    contents = get_table('contents')
+    rs = contents.update().where(contents.c.content_id == comp['content_id']).values(comp)
+    rs.execute()
+    invalidate(content_key(comp['content_id']))
+    if 'display_status' in comp: invalidate_gallery([comp['content_id']])
+
+
+# ------------------------------------------------------------------------------
+def update_complaint(comp):
+    """ updates  in the complaints table
+        in: complaint json
+        out: updated complaint row
+    """
+    complaints = get_table('complaints')
+    rs = complaints.update().where(complaints.c.complaint_id == comp['complaint_id']).values(comp)
+    rs.execute()
+
+
+# ------------------------------------------------------------------------------
+def put_complaint(comp):
+    """ puts a complaint in the complaints table
+        in: complaint json
+        out: new complaint row
+        return complaint_id
+    """
+    complaints = get_table('complaints')
+    rs = complaints.insert()
+    out = rs.execute(comp)
+
+    return out.lastrowid
+
+
+# ------------------------------------------------------------------------------
+def get_complaint(cid):
+    """ queries the content table and returns a single value
+        in: content_id
+        return content row
+    """
+    complaints = get_table('complaints')
+    rs = complaints.select().where(complaints.c.complaint_id == str(cid)).limit(1)
+
+    return first_record(rs.execute())
+
+
+# ------------------------------------------------------------------------------
+def get_content(cid):
+    """ queries the content table and returns a single value
+        in: content_id
+        return content row
+    """
+    def load():
+        contents = get_table('contents')
+        rs = contents.select().where(contents.c.content_id == str(cid)).limit(1)
+        return first_record(rs.execute())
+
+    return cached(content_key(cid), load)
+
+
+# ------------------------------------------------------------------------------
+def get_complaints_for_content(cid):
+    """ queries the complaints table for all complaints about a single content
+        in: content id
+        return all complaints about that content
+    """
+    complaints = get_table('complaints')
+    rs = complaints.select().where(complaints.c.content_id == str(cid))
+
+    return list(iter_records(rs.execute()))
+
+
+# ------------------------------------------------------------------------------
+def get_reviewer_from_email(email):
+    """ queries the reviewers table for reviewer with this email
+        assumes a one to one mapping between reviewers and emails
+        in: email
+        return reviewer
+    """
+    def load():
+        reviewers = get_table('reviewers')
+        rs = reviewers.select().where(reviewers.c.email == email).limit(1)
+        return first_record(rs.execute())
+
+    return cached('reviewer:' + email, load)
+
+
+# ------------------------------------------------------------------------------
+def get_pinner_from_email(email):
+    """ queries the pinners table for pinner with this email
+        assumes a one to one mapping between pinners and emails
+        in: email
+        return pinner
+    """
+    def load():
+        pinners = get_table('pinners')
+        rs = pinners.select().where(pinners.c.email == email).limit(1)
+        return first_record(rs.execute())
+
+    return cached('pinner:' + email, load)
+
+
+# ------------------------------------------------------------------------------
+def get_page(name, key, cursor=None, limit=None, **filters):
+    """ keyset pagination over a table, rows come back ordered by the key
+        column and start after the cursor, so each page is an index range
+        scan no matter how deep into the table it is
+        in: table name, key column, cursor (last key of the previous page),
+            limit (None for all rows), column=value equality filters
+        return list of records
+    """
+    return list(iter_page(name, key, cursor, limit, **filters))
+
+
+# ------------------------------------------------------------------------------
+def iter_page(name, key, cursor=None, limit=None, **filters):
+    """ get_page as a stream, rows are read from a server side cursor where
+        the driver has one and mapped one at a time, so a long listing or an
+        export never holds the whole result in memory
+        in: as get_page
+        return iterator of records
+    """
+    table = get_table(name)
+    rs = table.select()
+    for column, value in filters.items():
+        if value != None: rs = rs.where(table.c[column] == value)
+    if cursor != None: rs = rs.where(table.c[key] > int(cursor))
+    rs = rs.order_by(table.c[key])
+    if limit != None: rs = rs.limit(int(limit))
+
+    return iter_records(rs.execution_options(stream_results=True).execute())
+
+
+# ------------------------------------------------------------------------------
+def next_cursor(rows, key, limit):
+    """ cursor for the page after this one
+        in: rows of the current page, key column, limit used for the page
+        return last key of the page, or None when there are no more pages
+    """
+    if limit == None or len(rows) < int(limit): return None
+
+    return rows[-1][key]
+
+
+# ------------------------------------------------------------------------------
+def get_pinners_list(cursor=None, limit=None):
+    """ queries the pinners table and returns the values
+        in: optional cursor and limit for paging
+        return pinners list
+    """
+    key = 'pinners:{}:{}'.format(cursor, limit)
+    return cached(key, lambda: get_page('pinners', 'pinner_id', cursor, limit))
+
+
+# ------------------------------------------------------------------------------
+def get_reviewers_list(cursor=None, limit=None):
+    """ queries the reviewers table and returns the values
+        in: optional cursor and limit for paging
+        return reviewers list
+    """
+    key = 'reviewers:{}:{}'.format(cursor, limit)
+    return cached(key, lambda: get_page('reviewers', 'reviewer_id', cursor, limit))
+
+
+# ------------------------------------------------------------------------------
+def get_content_list(cursor=None, limit=None, display_status=None):
+    """ queries the content table and returns the values
+        in: optional cursor and limit for paging, optional display_status
+        return content list
+    """
+    return get_page('contents', 'content_id', cursor, limit, display_status=display_status)
+
+
+# ------------------------------------------------------------------------------
+def get_complaint_list(cursor=None, limit=None, process_status=None, display_status=None):
+    """ queries the complaint table and returns the values
+        in: optional cursor and limit for paging, optional process_status
+            and display_status
+        return complaint list
+    """
+    return get_page('complaints', 'complaint_id', cursor, limit,
+                    process_status=process_status, display_status=display_status)
+
+
+# ------------------------------------------------------------------------------
+def hour_bucket(column):
+    """ sql expression truncating a timestamp column to the hour
+        in: timestamp column
+        return sql expression
+    """
+    if get_db().dialect.name == 'sqlite':
+        return func.strftime('%Y-%m-%d %H:00', column)
+
+    return func.date_format(column, '%Y-%m-%d %H:00')
+
+
+# ------------------------------------------------------------------------------
+def get_complaint_stats(hours=24):
+    """ summarizes the recent complaints, counting is done by the database
+        with one GROUP BY over the complaints that arrived in the last hours,
+        a range of the complaint_timestamp index, so the cost grows with the
+        recent traffic and not with the whole history
+        in: hours of history to report
+        return dict of counts by process_status, display_status and
+            complaint_type in the window, age of the oldest pending complaint
+            in seconds, complaints per hour and the window in hours
+    """
+    stats = {'hours': hours}
+    complaints = get_table('complaints')
+    since = datetime.datetime.now() - datetime.timedelta(hours=hours)
+
+    # one pass over the window, summed per column here
+    columns = ['process_status', 'display_status', 'complaint_type']
+    rs = select([complaints.c[column] for column in columns] + [func.count()]).\
+        where(complaints.c.complaint_timestamp >= since).\
+        group_by(*[complaints.c[column] for column in columns])
+    for column in columns: stats[column] = {}
+    for row in rs.execute():
+        for i, column in enumerate(columns):
+            stats[column][row[i]] = stats[column].get(row[i], 0) + row[-1]
+
+    # oldest pending complaint, first row of the (process_status, complaint_id) index
+    rs = select([complaints.c.complaint_timestamp]).\
+        where(complaints.c.process_status == 'complaint').\
+        order_by(complaints.c.complaint_id).limit(1)
+    oldest = rs.execute().scalar()
+    stats['oldest_pending'] = None
+    if oldest != None:
+        stats['oldest_pending'] = int((datetime.datetime.now() - oldest).total_seconds())
+
+    # arrivals per hour
+    hour = hour_bucket(complaints.c.complaint_timestamp)
+    rs = select([hour, func.count()]).\
+        where(complaints.c.complaint_timestamp >= since).\
+        group_by(hour).order_by(hour)
+    stats['per_hour'] = [(h, n) for h, n in rs.execute()]
+
+    return stats
+
+
+# ------------------------------------------------------------------------------
+def insert_ignore(table):
+    """ insert statement that skips rows whose primary or unique key is
+        already in the table instead of failing
+        in: table
+        return sqlalchemy insert, raises NotImplementedError for a dialect
+            without one
+    """
+    dialect = get_db().dialect.name
+    if dialect == 'mysql': return table.insert().prefix_with('IGNORE')
+    if dialect == 'sqlite': return table.insert().prefix_with('OR IGNORE')
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+
+    raise NotImplementedError("no insert ignore for {}".format(dialect))
+
+
+# ------------------------------------------------------------------------------
+def get_review_order():
+    """ returns how reviews are handed out, 'fifo' (the sqs queue order)
+        unless the secrets set 'review_order' to 'priority'
+        return review order
+    """
+    return 'priority' if get_secrets().get('review_order') == 'priority' else 'fifo'
+
+
+# ------------------------------------------------------------------------------
+def review_rank(claimed, complaint_type, count):
+    """ position of a pending review in the priority order, lowest first.
+        The claim time is moved earlier by review_boost for the complaint
+        type and by review_per_complaint for every further open complaint,
+        so both waiting and complaint volume move a content up, and the
+        order of two reviews does not change as time passes.
+        in: claim time in epoch seconds, complaint_type, open complaints
+        return rank
+    """
+    return int(claimed - review_boost.get(complaint_type, 0) - review_per_complaint * (count - 1))
+
+
+# ------------------------------------------------------------------------------
+def bump_reviews(conn, counts):
+    """ adds open complaints to pending reviews and moves each review up by
+        review_per_complaint per complaint, in content order so concurrent
+        batches lock the rows in the same order
+        in: connection in a transaction, dict content_id -> new complaints
+        out: updated pending_reviews rows
+    """
+    pending = get_table('pending_reviews')
+    for cid in sorted(counts):
+        rs = pending.update().where(pending.c.content_id == cid).values(
+            complaints=pending.c.complaints + counts[cid],
+            review_rank=pending.c.review_rank - review_per_complaint * counts[cid])
+        conn.execute(rs)
+
+
+# ------------------------------------------------------------------------------
+def claim_review(cid, complaint_id, complaint_type='objectionable'):
+    """ claims the pending review of a content with one atomic insert. The
+        pending_reviews primary key allows one row per content, so of any
+        number of concurrent complaints about a content exactly one wins.
+        review_complaint deletes the claim when the content is reviewed.
+        in: content_id the review is claimed under (review_key), complaint_id
+            of the complaint asking for review, complaint_type
+        out: pending_reviews row
+        return True if this complaint claimed the review
+    """
+    pending = get_table('pending_reviews')
+    now = datetime.datetime.now()
+    claim = {'content_id': int(cid), 'complaint_id': complaint_id, 'claimed_at': now,
+             'complaints': 1, 'review_rank': review_rank(now.timestamp(), complaint_type, 1)}
+
+    try: rs = insert_ignore(pending)
+    except NotImplementedError:
+        # the primary key refuses the inserts that lose
+        try: pending.insert().execute(claim)
+        except sqlalchemy.exc.IntegrityError: return False
+        return True
+
+    return rs.execute(claim).rowcount == 1
+
+
+# ------------------------------------------------------------------------------
+def mark_queued(conn, claims):
+    """ notes that the review messages of claims were sent, a claim without
+        queued_at is one whose message never went out, see reconcile
+        in: connection, dict content_id -> complaint_id of the claims sent
+        out: pending_reviews.queued_at
+    """
+    if not claims: return
+    pending = get_table('pending_reviews')
+    conn.execute(pending.update().where(and_(
+        pending.c.content_id.in_(sorted(claims)),
+        pending.c.complaint_id.in_(sorted(claims.values())))).values(queued_at=datetime.datetime.now()))
+
+
+# ------------------------------------------------------------------------------
+def review_key(cid):
+    """ the content a content's review is claimed under: the first image of
+        its near duplicate group, so one review covers every copy of an
+        image, or the content itself if it has no near duplicates or was
+        not indexed
+        in: content_id
+        return content_id
+    """
+    def load():
+        hashes = get_table('content_hashes')
+        rs = select([hashes.c.group_id]).where(hashes.c.content_id == int(cid)).limit(1)
+        row = rs.execute().fetchone()
+        return row[0] if row != None and row[0] != None else int(cid)
+
+    return cached(group_key(cid), load)
+
+
+# ------------------------------------------------------------------------------
+def review_keys(cids):
+    """ review_key of several contents with one query
+        in: content_ids
+        return dict content_id -> content_id the review is claimed under
+    """
+    keys = dict((int(cid), int(cid)) for cid in cids)
+    if not keys: return keys
+
+    hashes = get_table('content_hashes')
+    rs = select([hashes.c.content_id, hashes.c.group_id]).where(hashes.c.content_id.in_(sorted(keys)))
+    for cid, group_id in rs.execute():
+        if group_id != None: keys[cid] = group_id
+
+    return keys
+
+
+# ------------------------------------------------------------------------------
+def near_group(column, cid):
+    """ condition on a content_id column matching a content and its near
+        duplicates, a subquery on the group index so a group of any size is
+        one statement
+        in: content_id column, content_id
+        return sqlalchemy condition
+    """
+    hashes = get_table('content_hashes')
+    members = select([hashes.c.content_id]).where(hashes.c.group_id == review_key(cid))
+
+    return or_(column == int(cid), column.in_(members))
+
+
+# ------------------------------------------------------------------------------
+def get_near_tree(refresh=False):
+    """ the BK-tree of the group representatives, the hash of each group's
+        first image, read from content_hashes on first use. It is only
+        needed to index new images, and takes a few hundred bytes per group.
+        in: refresh, read the table again
+        return nearby.BKTree of representative hash -> group_id
+    """
+    global near_tree
+    from chalicelib import nearby
+
+    if near_tree == None or refresh:
+        hashes = get_table('content_hashes')
+        tree = nearby.BKTree()
+        rs = select([hashes.c.phash, hashes.c.group_id]).where(hashes.c.content_id == hashes.c.group_id)
+        for row in rs.execution_options(stream_results=True).execute():
+            tree.add(nearby.to_unsigned(row[0]), row[1])
+        near_tree = tree
+
+    return near_tree
+
+
+# ------------------------------------------------------------------------------
+def add_content_hashes(found, distance=None):
+    """ indexes content images, each joins the group whose representative,
+        the group's first image, is nearest within distance bits, or starts
+        a group of its own and becomes its representative. Comparing with
+        the representative rather than any member keeps groups from
+        chaining: every member is within distance of the first image, so
+        two members differ in at most twice the distance. A content keeps
+        its group once indexed.
+        in: dict content_id -> 64 bit image hash, distance (near_distance)
+        out: content_hashes rows
+        return dict content_id -> group_id
+    """
+    from chalicelib import nearby
+
+    distance = near_distance if distance == None else distance
+    tree = get_near_tree()
+    rows = []
+    for cid in sorted(found):
+        near = tree.find(found[cid], distance)
+        group_id = near[0][1] if near else int(cid)
+        if group_id == int(cid): tree.add(found[cid], group_id)
+        rows.append({'content_id': int(cid), 'phash': nearby.to_signed(found[cid]), 'group_id': group_id})
+
+    if rows:
+        get_db().execute(insert_ignore(get_table('content_hashes')), rows)
+        invalidate(*[group_key(row['content_id']) for row in rows])
+
+    return dict((row['content_id'], row['group_id']) for row in rows)
+
+
+# ------------------------------------------------------------------------------
+def image_path(image_dir, url):
+    """ the local file of a content image, the url path under image_dir, or
+        failing that the file name
+        in: image directory, content url
+        return path
+    """
+    path = urllib.parse.urlparse(url).path.lstrip('/')
+    for candidate in (os.path.join(image_dir, path), os.path.join(image_dir, os.path.basename(path))):
+        if os.path.isfile(candidate): return candidate
+
+    return os.path.join(image_dir, path)
+
+
+# ------------------------------------------------------------------------------
+def index_content_images(image_dir, workers=None, distance=None, chunk=None):
+    """ hashes the images of the contents that are not indexed yet from
+        local files, in a pool of worker processes, and adds them to their
+        near duplicate groups chunk at a time. The contents are read by
+        keyset pages, so the memory is a chunk plus the BK-tree.
+        in: image directory, worker processes (one per cpu), distance
+            (near_distance), contents per chunk (bulk_chunk)
+        out: content_hashes rows
+        return progress counters
+    """
+    from chalicelib import nearby
+
+    counters = {'contents': 0, 'indexed': 0, 'missing': 0, 'grouped': 0, 'seconds': 0.0}
+    start = time.time()
+    chunk = chunk or bulk_chunk
+    contents = get_table('contents')
+    hashes = get_table('content_hashes')
+
+    def unindexed():
+        cursor = 0
+        while True:
+            rs = select([contents.c.content_id, contents.c.url]).\
+                select_from(contents.outerjoin(hashes, hashes.c.content_id == contents.c.content_id)).\
+                where(and_(hashes.c.content_id == None, contents.c.content_id > cursor)).\
+                order_by(contents.c.content_id).limit(chunk)
+            rows = rs.execute().fetchall()
+            if not rows: return
+            for cid, url in rows: yield cid, image_path(image_dir, url or '')
+            cursor = rows[-1][0]
+
+    found = {}
+    def add():
+        groups = add_content_hashes(found, distance)
+        counters['indexed'] += len(groups)
+        counters['grouped'] += sum(1 for cid, group_id in groups.items() if cid != group_id)
+        found.clear()
+
+    for cid, value in nearby.hash_files(unindexed(), workers):
+        counters['contents'] += 1
+        if value == None: counters['missing'] += 1
+        else: found[cid] = value
+        if len(found) >= chunk: add()
+    add()
+
+    counters['seconds'] = round(time.time() - start, 3)
+    inf("indexed {indexed} images, {grouped} near duplicates, {missing} missing, {seconds} s".format(**counters))
+
+    return counters
+
+
+# ------------------------------------------------------------------------------
+def file_complaint(redata):
+    """ handles a new complaint, creates complaint row, sends sqs message if 
+        the complaint claimed the content's review
+        in: data from cs_submit page
+        out: complaint record, SQS message if necessary
+        return complaint_id
+    """
+    complaint = {}
+    
+    # create the complaint
+    complaint['complaint_timestamp'] = datetime.datetime.now()
+    complaint['complaint_type'] = 'objectionable'
+    complaint['process_status'] = 'complaint'
+    complaint['display_status'] = redata['display_status']
+    
+    pinner = get_pinner_from_email(redata['pinner'])
+    complaint['pinner_id'] = pinner['pinner_id']
+    
+    complaint['content_id'] = int(redata['content_id'])
+
+    # post the complaint to the table
+    complaint_id = put_complaint(complaint)
+
+    # claim the review of this content, if it is already in the queue for
+    # review the claim fails, no sqs message is sent and the review moves up.
+    # near duplicate images share the claim of their group's first image
+    key = review_key(complaint['content_id'])
+    sqsmessage = claim_review(key, complaint_id, complaint['complaint_type'])
+    if not sqsmessage:
+        with get_db().begin() as conn: bump_reviews(conn, {key: 1})
+    
+    # post the complain to the sqs queue, in priority order the claim is the queue entry
+    if sqsmessage and get_review_order() == 'fifo':
+        complaint['complaint_timestamp'] = str(complaint['complaint_timestamp'])
+        complaint['complaint_id'] = complaint_id
+        sqs_id = put_sqsmessage(complaint)
+        if sqs_id == 'error': err("complaint {} was filed but not queued for review".format(complaint_id))
+        else: mark_queued(get_db(), {key: complaint_id})
+    
+    return complaint_id
+
+
+# ------------------------------------------------------------------------------
+def get_ingest_mode():
+    """ returns how cs_submit files complaints, 'sync' unless the secrets
+        set 'ingest_mode' to 'queue' or 'wal'. The write ahead log is on the
+        local disk and read by the consume command on the same machine, so
+        'wal' is refused under lambda, where /tmp belongs to one container
+        and is lost with it.
+        return ingest mode
+    """
+    mode = get_secrets().get('ingest_mode', 'sync')
+    if mode not in ingest_modes:
+        war("unknown ingest mode {}, filing complaints at once".format(mode))
+        mode = 'sync'
+    if mode == 'wal' and os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        war("the wal ingest mode is not durable under lambda, filing complaints at once")
+        mode = 'sync'
+    if mode == 'queue' and not ingest_queue_name:
+        war("the queue ingest mode needs CS_INGEST_QUEUE, filing complaints at once")
+        mode = 'sync'
+
+    return mode
+
+
+# ------------------------------------------------------------------------------
+def get_ingest_url():
+    """ returns the ingest queue url, resolved only once from the queue name
+        in CS_INGEST_QUEUE, the one name the ingest_consumer lambda is
+        subscribed to as well
+        return queue url
+    """
+    global ingest_url
+    if ingest_url == None:
+        if not ingest_queue_name: raise KeyError('CS_INGEST_QUEUE')
+        ingest_url = get_client('sqs').get_queue_url(QueueName=ingest_queue_name)['QueueUrl']
+
+    return ingest_url
+
+
+ingest_deleter = SQSBatch('delete', max_wait=sqs_batch_wait, queue=get_ingest_url)
+
+
+# ------------------------------------------------------------------------------
+def validate_complaint(redata):
+    """ checks a complaint from the cs_submit page without touching the
+        database and stamps it with an ingest id and the time it arrived
+        in: data from cs_submit page
+        return complaint record, raises ValueError if the data is bad
+    """
+    redata = redata or {}
+    try: cid = int(redata.get('content_id'))
+    except (TypeError, ValueError): raise ValueError("content_id must be an integer")
+    if cid <= 0: raise ValueError("content_id must be positive")
+
+    pinner = (redata.get('pinner') or '').strip()
+    if '@' not in pinner or len(pinner) > 40: raise ValueError("pinner must be an email address")
+
+    display_status = redata.get('display_status') or 'good'
+    if len(display_status) > 20: raise ValueError("display_status is too long")
+
+    return {
+        'ingest_id': uuid.uuid4().hex,
+        'content_id': cid,
+        'pinner': pinner,
+        'display_status': display_status,
+        'complaint_timestamp': datetime.datetime.now().isoformat(sep=' ', timespec='microseconds')
+    }
+
+
+# ------------------------------------------------------------------------------
+def append_ingest_wal(record):
+    """ appends a complaint record to the write ahead log and syncs it to
+        disk. Each record is one line written with a single append, so
+        several writers can share the log.
+        in: complaint record
+        out: line in the write ahead log
+    """
+    path = get_secrets().get('ingest_wal', ingest_wal)
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# ------------------------------------------------------------------------------
+def read_ingest_wal(count):
+    """ reads complaint records from the write ahead log, starting where the
+        consumer last stopped. A last line without its newline is still
+        being written and is left for the next read.
+        in: most records to read
+        return list of records, log offset after them
+    """
+    path = get_secrets().get('ingest_wal', ingest_wal)
+    try:
+        with open(path + '.offset') as f: offset = int(f.read() or 0)
+    except (IOError, ValueError):
+        offset = 0
+
+    records = []
+    if not os.path.exists(path): return records, offset
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while len(records) < count:
+            line = f.readline()
+            if not line.endswith(b'\n'): break
+            offset += len(line)
+            if line.strip(): records.append(json.loads(line.decode()))
+
+    return records, offset
+
+
+# ------------------------------------------------------------------------------
+def write_ingest_offset(offset):
+    """ records how far the consumer got in the write ahead log, replacing
+        the offset file in one step so a crash leaves the old or the new one
+        in: log offset
+        out: offset file
+    """
+    path = get_secrets().get('ingest_wal', ingest_wal) + '.offset'
+    with open(path + '.tmp', 'w') as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+# ------------------------------------------------------------------------------
+def receive_ingest(count):
+    """ receives complaint messages from the ingest queue
+        in: most messages to receive
+        return list of sqs messages
+    """
+    messages = []
+    while len(messages) < count:
+        response = get_client('sqs').receive_message(
+            QueueUrl=get_ingest_url(),
+            MaxNumberOfMessages=min(10, count - len(messages)),
+            VisibilityTimeout=ingest_visibility
+        )
+        if not response.get('Messages'): break
+        messages += response['Messages']
+
+    return messages
+
+
+# ------------------------------------------------------------------------------
+def ingest_complaint(redata):
+    """ fast path for a new complaint: validates it, writes it to the ingest
+        queue or the write ahead log and returns without a database call.
+        consume_ingest files the buffered complaints in batches. If the
+        queue cannot take the complaint, is out of reach or is not named
+        (CS_INGEST_QUEUE) it is filed at once instead.
+        in: data from cs_submit page
+        out: complaint record in the ingest buffer
+        return ingest id, or complaint_id if the complaint was filed at once
+    """
+    record = validate_complaint(redata)
+
+    if get_ingest_mode() == 'wal':
+        append_ingest_wal(record)
+        return record['ingest_id']
+
+    try:
+        get_client('sqs').send_message(QueueUrl=get_ingest_url(), MessageBody=json.dumps(record))
+    except (ClientError, BotoCoreError, KeyError):
+        war("ingest queue refused complaint {}, filing it now".format(record['ingest_id']))
+        return file_complaint(redata)
+
+    return record['ingest_id']
+
+
+# ------------------------------------------------------------------------------
+def file_complaint_batch(records, counters=None):
+    """ files a batch of buffered complaints with a fixed number of
+        statements: one pinner lookup, one multi-row insert, one id lookup,
+        and a claim check, one multi-row claim and a second check, then the
+        review messages go out with batch sends. The ingest_id column is
+        unique, so a batch delivered twice is filed and queued once.
+        in: list of complaint records from validate_complaint, counters,
+            optional dict whose 'filed' and 'known' counts are increased by
+            the complaints new in this batch and those filed before
+        out: complaint rows, pending_reviews rows, sqs messages
+        return dict ingest_id -> complaint_id for the complaints of the
+            batch, new or filed before
+    """
+    if not records: return {}
+    complaints = get_table('complaints')
+    pinners = get_table('pinners')
+    pending = get_table('pending_reviews')
+
+    # one lookup for every pinner in the batch
+    emails = sorted(set(r['pinner'] for r in records))
+    rs = select([pinners.c.email, pinners.c.pinner_id]).where(pinners.c.email.in_(emails))
+    pinner_ids = dict((row[0], row[1]) for row in rs.execute())
+
+    unknown = [r['pinner'] for r in records if r['pinner'] not in pinner_ids]
+    if unknown: war("{} complaints from unknown pinners dropped: {}".format(len(unknown), sorted(set(unknown))))
+
+    rows = []
+    for r in records:
+        if r['pinner'] not in pinner_ids: continue
+        rows.append({
+            'ingest_id': r['ingest_id'],
+            'complaint_timestamp': datetime.datetime.strptime(r['complaint_timestamp'], '%Y-%m-%d %H:%M:%S.%f'),
+            'complaint_type': r.get('complaint_type', 'objectionable'),
+            'process_status': 'complaint',
+            'display_status': r['display_status'],
+            'pinner_id': pinner_ids[r['pinner']],
+            'content_id': int(r['content_id'])
+        })
+    if not rows: return {}
+
+    # near duplicate images are claimed under their group's first image
+    keys = review_keys(set(row['content_id'] for row in rows))
+
+    with get_db().begin() as conn:
+        # complaints already filed by an earlier delivery do not count again
+        rs = select([complaints.c.ingest_id]).where(complaints.c.ingest_id.in_([row['ingest_id'] for row in rows]))
+        known = set(row[0] for row in conn.execute(rs))
+        added = collections.Counter(keys[row['content_id']] for row in rows if row['ingest_id'] not in known)
+
+        conn.execute(insert_ignore(complaints), rows)
+
+        # the ids of this batch's complaints, new or filed by an earlier delivery
+        rs = select([complaints.c.ingest_id, complaints.c.complaint_id, complaints.c.process_status]).\
+            where(complaints.c.ingest_id.in_([row['ingest_id'] for row in rows]))
+        found = dict((row[0], (row[1], row[2])) for row in conn.execute(rs))
+
+        # each review's first open complaint in the batch asks for it
+        first = {}
+        for row in rows:
+            complaint_id, status = found[row['ingest_id']]
+            if status != 'complaint': continue
+            key = keys[row['content_id']]
+            if key not in first or complaint_id < first[key][0]: first[key] = (complaint_id, row)
+
+        # contents already claimed, by other complaints or an earlier delivery of this batch
+        rs = select([pending.c.content_id]).where(pending.c.content_id.in_(list(first)))
+        fresh = set(first) - set(row[0] for row in conn.execute(rs)) if first else set()
+
+        claimed = {}
+        if fresh:
+            now = datetime.datetime.now()
+            claims = []
+            for cid in fresh:
+                count = max(added[cid], 1)
+                claims.append({'content_id': cid, 'complaint_id': first[cid][0], 'claimed_at': now, 'complaints': count,
+                               'review_rank': review_rank(now.timestamp(), first[cid][1]['complaint_type'], count)})
+            conn.execute(insert_ignore(pending), claims)
+            rs = select([pending.c.content_id, pending.c.complaint_id]).where(pending.c.content_id.in_(list(fresh)))
+            claimed = dict((row[0], row[1]) for row in conn.execute(rs))
+
+        # the new complaints about contents claimed before move those reviews up
+        bump_reviews(conn, dict((cid, n) for cid, n in added.items()
+                                if cid in first and claimed.get(cid) != first[cid][0]))
+
+    # only the contents this batch claimed go to the review queue, in
+    # priority order the claim is the queue entry
+    won = [cid for cid in sorted(first) if claimed.get(cid) == first[cid][0]]
+    comps = []
+    for cid in won if get_review_order() == 'fifo' else []:
+        complaint_id, row = first[cid]
+        comp = dict((k, v) for k, v in row.items() if k != 'ingest_id')
+        comp['complaint_timestamp'] = str(comp['complaint_timestamp'])
+        comp['complaint_id'] = complaint_id
+        comps.append(comp)
+    sent = {}
+    for key, comp, sqs_id in zip(won, comps, put_sqsmessages(comps)):
+        if sqs_id == 'error': err("complaint {} was filed but not queued for review".format(comp['complaint_id']))
+        else: sent[key] = comp['complaint_id']
+    mark_queued(get_db(), sent)
+
+    filed = dict((row['ingest_id'], found[row['ingest_id']][0]) for row in rows)
+    new = len(set(filed) - known)
+    if counters != None:
+        counters['filed'] = counters.get('filed', 0) + new
+        counters['known'] = counters.get('known', 0) + len(filed) - new
+    inf("filed {} complaints, {} filed before, {} reviews claimed".format(new, len(filed) - new, len(won)))
+
+    return filed
+
+
+# ------------------------------------------------------------------------------
+def read_feed(feed, fmt):
+    """ reads a complaint feed one row at a time
+        in: open text file, 'csv' (with a header row) or 'ndjson'
+        return iterator of (line number, row dict or None if unreadable)
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(feed)
+        for row in reader: yield reader.line_num, row
+    else:
+        for line_num, line in enumerate(feed, 1):
+            if not line.strip(): continue
+            try: yield line_num, json.loads(line)
+            except ValueError: yield line_num, None
+
+
+# ------------------------------------------------------------------------------
+def feed_record(row):
+    """ turns a feed row into a complaint record. The ingest id is derived
+        from the partner's report_id when the feed has one, otherwise from
+        the row's values, so importing the same rows again, from any file,
+        files nothing new, while feeds that reuse a file name (a daily
+        reports.csv) do not collide.
+        in: row with content_id, pinner and optionally report_id,
+            display_status, complaint_type and complaint_timestamp
+        return complaint record, raises ValueError if the row is bad
+    """
+    if not isinstance(row, dict): raise ValueError("not a json object")
+    record = validate_complaint(row)
+
+    complaint_type = row.get('complaint_type') or 'objectionable'
+    if len(complaint_type) > 80: raise ValueError("complaint_type is too long")
+    record['complaint_type'] = complaint_type
+
+    if row.get('complaint_timestamp'):
+        text = str(row['complaint_timestamp']).replace('T', ' ')
+        try: stamp = datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S.%f')
+        except ValueError:
+            try: stamp = datetime.datetime.strptime(text, '%Y-%m-%d %H:%M:%S')
+            except ValueError: raise ValueError("complaint_timestamp must be YYYY-MM-DD HH:MM:SS")
+        record['complaint_timestamp'] = stamp.isoformat(sep=' ', timespec='microseconds')
+
+    if row.get('report_id'):
+        key = 'report:{}'.format(row['report_id'])
+    else:
+        key = json.dumps([record['content_id'], record['pinner'], record['display_status'], complaint_type,
+                          record['complaint_timestamp'] if row.get('complaint_timestamp') else None])
+    record['ingest_id'] = hashlib.md5(key.encode()).hexdigest()
+
+    return record
+
+
+# ------------------------------------------------------------------------------
+def file_complaints_bulk(path, fmt=None, chunk_size=None):
+    """ imports a complaint feed file, e.g. a backfill or a partner's abuse
+        reports. The file is streamed and filed chunk_size rows at a time
+        with file_complaint_batch: one pinner lookup, one multi-row insert
+        and one claim pass per chunk, review messages in batch sends.
+        Rows that fail validation or name an unknown pinner are logged and
+        skipped, rows filed before are counted as known.
+        in: path of a csv or ndjson file, fmt, 'csv' or 'ndjson' if the
+            extension does not say, chunk_size, rows per batch
+        out: complaint rows, pending_reviews rows, sqs messages
+        return progress counters
+    """
+    chunk_size = chunk_size or bulk_chunk
+    fmt = fmt or ('csv' if path.endswith('.csv') else 'ndjson')
+    source = os.path.basename(path)
+    counters = {'rows': 0, 'filed': 0, 'known': 0, 'rejected': 0, 'dropped': 0, 'chunks': 0,
+                'seconds': 0.0, 'rows_per_second': 0.0}
+    start = time.time()
+
+    def file_chunk(chunk):
+        filed = file_complaint_batch(chunk, counters)
+        counters['dropped'] += len(chunk) - len(filed)
+        counters['chunks'] += 1
+        inf("imported {rows} rows, {filed} filed, {known} known".format(**counters))
+
+    chunk = []
+    with open(path, newline='') as feed:
+        for line_num, row in read_feed(feed, fmt):
+            counters['rows'] += 1
+            try: chunk.append(feed_record(row))
+            except ValueError as e:
+                war("{} line {} rejected: {}".format(source, line_num, e))
+                counters['rejected'] += 1
+                continue
+
+            if len(chunk) >= chunk_size:
+                file_chunk(chunk)
+                chunk = []
+    if chunk: file_chunk(chunk)
+
+    counters['seconds'] = round(time.time() - start, 3)
+    if counters['seconds']: counters['rows_per_second'] = round(counters['rows'] / counters['seconds'], 1)
+    inf("imported {rows} rows from {}, {filed} filed, {known} known, {rejected} rejected, {dropped} dropped, "
+        "{rows_per_second} rows/s".format(source, **counters))
+
+    return counters
+
+
+# ------------------------------------------------------------------------------
+def consume_ingest(max_records=1000):
+    """ files buffered complaints in batches of ingest_batch until the buffer
+        is empty or max_records were read. A batch leaves the buffer only
+        after it is filed, so a failure means it is filed again later.
+        in: max_records
+        out: complaint rows, emptied ingest buffer
+        return progress counters
+    """
+    counters = {'records': 0, 'filed': 0, 'batches': 0, 'seconds': 0.0}
+    start = time.time()
+    mode = get_ingest_mode()
+    if mode == 'sync': return counters
+
+    with ingest_lock:
+        while counters['records'] < max_records:
+            count = min(ingest_batch, max_records - counters['records'])
+            if mode == 'wal':
+                records, offset = read_ingest_wal(count)
+            else:
+                messages = receive_ingest(count)
+                records = [json.loads(m['Body']) for m in messages]
+            if not records: break
+
+            filed = file_complaint_batch(records)
+
+            if mode == 'wal':
+                write_ingest_offset(offset)
+            else:
+                results = []
+                for m in messages: results += ingest_deleter.add(m['ReceiptHandle'])
+                report_sqsbatch(results + ingest_deleter.flush(), 'ingest delete')
+
+            counters['records'] += len(records)
+            counters['filed'] += len(filed)
+            counters['batches'] += 1
+
+    counters['seconds'] = round(time.time() - start, 3)
+    if counters['records']: inf("ingested {records} complaints in {batches} batches, {seconds} s".format(**counters))
+
+    return counters
+
+
+# ------------------------------------------------------------------------------
+def pop_review(lease=None):
+    """ leases the pending review with the lowest review_rank to a reviewer
+        for sqs_visibility seconds. The rank index makes this one index
+        lookup however long the backlog is. A review whose lease runs out
+        is handed out again.
+        in: lease, seconds to lease the review for instead of sqs_visibility
+        return complaint json like the sqs message body, None if no review
+            is waiting
+    """
+    pending = get_table('pending_reviews')
+    for attempt in range(5):
+        now = datetime.datetime.now()
+        free = or_(pending.c.leased_until == None, pending.c.leased_until < now)
+        with get_db().begin() as conn:
+            rs = select([pending.c.content_id, pending.c.complaint_id]).where(free).\
+                order_by(pending.c.review_rank).limit(1)
+            row = conn.execute(rs).fetchone()
+            if row == None: return None
+
+            # another reviewer may have leased it since the select
+            rs = pending.update().where(and_(pending.c.content_id == row[0], free)).\
+                values(leased_until=now + datetime.timedelta(seconds=lease or sqs_visibility))
+            if conn.execute(rs).rowcount == 1: break
+    else:
+        war("no review leased after {} attempts".format(attempt + 1))
+        return None
+
+    complaint = get_complaint(row[1])
+    if complaint == None: return None
+    complaint = complaint._asdict()
+    complaint['complaint_timestamp'] = str(complaint['complaint_timestamp'])
+
+    return complaint
+
+
+# ------------------------------------------------------------------------------
+def next_review(lease=None):
+    """ gets the next complaint for a reviewer, from the sqs queue or, in
+        priority order, from the pending_reviews rank index
+        in: lease, seconds the reviewer holds it instead of sqs_visibility
+        return complaint json, sqs message id, sqs message receipt handle
+            (both '' in priority order)
+    """
+    if get_review_order() == 'fifo': return get_sqsmessage(lease)
+
+    try: comp = pop_review(lease)
+    except:
+        err("problem reading the pending reviews")
+        return 'error', 'error', 'error'
+    if comp == None: return None, None, None
+
+    return comp, '', ''
+
+
+# ------------------------------------------------------------------------------
+def get_review_item(complaint_id):
+    """ one query for everything the review page shows: the complaint, its
+        content and a summary of the open complaints the decision resolves,
+        those of the content and of its near duplicates
+        in: complaint_id
+        return review item, None if there is no such complaint
+    """
+    complaints = get_table('complaints')
+    contents = get_table('contents')
+    comp = complaints.alias('comp')
+    other = complaints.alias('other')
+
+    # the content's near duplicate group, as review_complaint resolves it
+    hashes = get_table('content_hashes')
+    own = hashes.alias('own')
+    near = hashes.alias('near')
+    group = select([near.c.content_id]).select_from(near.join(own, own.c.group_id == near.c.group_id)).\
+        where(own.c.content_id == comp.c.content_id).correlate(comp)
+
+    def summary(column):
+        return select([column]).where(and_(
+            or_(other.c.content_id == comp.c.content_id, other.c.content_id.in_(group)),
+            other.c.process_status == 'complaint')).correlate(comp).as_scalar()
+
+    # the other images in the content's near duplicate group
+    near_duplicates = select([func.count()]).select_from(near.join(own, own.c.group_id == near.c.group_id)).\
+        where(and_(own.c.content_id == comp.c.content_id, near.c.content_id != comp.c.content_id)).\
+        correlate(comp).as_scalar()
+
+    rs = select([
+        comp.c.complaint_id, comp.c.complaint_type, comp.c.complaint_timestamp, comp.c.process_status,
+        contents.c.content_id, contents.c.url, contents.c.display_status,
+        summary(func.count()).label('open_complaints'),
+        summary(func.min(other.c.complaint_timestamp)).label('first_complaint'),
+        summary(func.max(other.c.complaint_timestamp)).label('last_complaint'),
+        near_duplicates.label('near_duplicates')
+    ]).select_from(comp.join(contents, contents.c.content_id == comp.c.content_id)).\
+        where(comp.c.complaint_id == int(complaint_id))
+    row = rs.execute().fetchone()
+
+    return dict(row) if row != None else None
+
+
+# ------------------------------------------------------------------------------
+def fetch_review_item(lease):
+    """ leases the next review and joins it with its content
+        in: lease, seconds the review is held
+        return review item with its sqs_handle, None if no review is
+            waiting, 'error' if the queue cannot be read
+    """
+    while True:
+        message, sqs_id, sqs_handle = next_review(lease)
+        if message == None or message == 'error': return message
+
+        item = get_review_item(message['complaint_id'])
+        if item != None and item['process_status'] != 'done': break
+        war("complaint {} for review is {}".format(message['complaint_id'], 'done' if item else 'missing'))
+        if sqs_handle: delete_sqsmessage(sqs_handle)
+        repair_claim(review_key(message['content_id']), message['complaint_id'])
+
+    item['sqs_handle'] = sqs_handle
+    item['leased'] = time.time()
+
+    return item
+
+
+# ------------------------------------------------------------------------------
+def extend_review(item):
+    """ extends a prefetched review's short lease to sqs_visibility
+        in: review item
+        return True if the lease was still held
+    """
+    if item['sqs_handle']:
+        try:
+            get_client('sqs').change_message_visibility(QueueUrl=get_queue_url(),
+                ReceiptHandle=item['sqs_handle'], VisibilityTimeout=sqs_visibility)
+        except ClientError:
+            return False
+        return True
+
+    pending = get_table('pending_reviews')
+    now = datetime.datetime.now()
+    rs = pending.update().where(and_(pending.c.content_id == review_key(item['content_id']), pending.c.leased_until > now)).\
+        values(leased_until=now + datetime.timedelta(seconds=sqs_visibility))
+
+    return rs.execute().rowcount == 1
+
+
+# ------------------------------------------------------------------------------
+def prefetch_review():
+    """ background thread body, leases the next review for sqs_hold seconds
+        and keeps it for the next reviewer request
+        out: review_prefetch
+    """
+    try: item = fetch_review_item(sqs_hold)
+    except:
+        war("review prefetch failed")
+        item = None
+    if item != 'error': review_prefetch['item'] = item
+
+
+# ------------------------------------------------------------------------------
+def next_review_item():
+    """ the next review with its content and complaint summary, served from
+        the prefetched review when there is one. Once it is served the
+        review after it is prefetched in the background, so it is ready
+        while the reviewer decides. A prefetched review holds only a short
+        lease (sqs_hold), extended when it is served; on lambda the thread
+        may be frozen with the container and finishes on the next request.
+        return review item, None if no review is waiting, 'error' on failure
+    """
+    with review_lock:
+        thread = review_prefetch['thread']
+        if thread != None: thread.join(timeout=5)
+
+        item, review_prefetch['item'] = review_prefetch['item'], None
+        if item != None and (time.time() - item['leased'] > sqs_hold - 5 or not extend_review(item)):
+            inf("prefetched review for content {} expired".format(item['content_id']))
+            review_stats['expired'] += 1
+            item = None
+        elif item != None:
+            review_stats['prefetched'] += 1
+        if item == None: item = fetch_review_item(sqs_visibility)
+
+        if item != None and item != 'error':
+            review_stats['served'] += 1
+            review_prefetch['thread'] = threading.Thread(target=prefetch_review, daemon=True)
+            review_prefetch['thread'].start()
+
+    return item
+
+
+# ------------------------------------------------------------------------------
+def release_prefetch():
+    """ gives the prefetched review back right away instead of when its
+        short lease runs out: the sqs message becomes visible again, or in
+        priority order the claim's lease is cleared
+        out: review_prefetch emptied
+        return True if a review was released
+    """
+    with review_lock:
+        thread = review_prefetch['thread']
+        if thread != None: thread.join(timeout=5)
+        item, review_prefetch['item'] = review_prefetch['item'], None
+    if item == None: return False
+
+    try:
+        if item['sqs_handle']:
+            get_client('sqs').change_message_visibility(QueueUrl=get_queue_url(),
+                ReceiptHandle=item['sqs_handle'], VisibilityTimeout=0)
+        else:
+            # only the prefetch's own lease, a later one belongs to another reviewer
+            pending = get_table('pending_reviews')
+            ours = datetime.datetime.fromtimestamp(item['leased'] + sqs_hold)
+            rs = pending.update().where(and_(pending.c.content_id == review_key(item['content_id']),
+                pending.c.leased_until <= ours)).values(leased_until=None)
+            rs.execute()
+    except:
+        war("cannot release the prefetched review of content {}, it returns after {} s".format(item['content_id'], sqs_hold))
+        return False
+
+    return True
+
+
+# ------------------------------------------------------------------------------
+def review_complaint(redata):
+    """ resolves all open complaints related to a given content and its
+        near duplicates, changes their display status if necessary. The
+        complaints and the contents are updated with one statement each in
+        a single transaction, so the cost does not grow with the number of
+        complaints or copies of the image.
+        in: data from review pop page
+        out: update complaint records, update display status if necessary
+        return number of complaints resolved
+    """
+    resolved = 0
+
+    # get data
+    complaint = get_complaint(redata['complaint_id'])
+
+    if complaint != None:
+        reviewer = get_reviewer_from_email(redata['reviewer'])
+        complaints = get_table('complaints')
+        contents = get_table('contents')
+        pending = get_table('pending_reviews')
+
+        # update data
+        values = {
+            'review_timestamp': datetime.datetime.now(),
+            'reviewer_id': reviewer['reviewer_id'],
+            'process_status': 'done'
+        }
+
+        # pull image from display if necessary
+        if redata['comp'] == 'Bad':
+            values['display_status'] = complaint['complaint_type']
+
+        # the decision covers every near duplicate of the image
+        cid = complaint['content_id']
+        key = review_key(cid)
+
+        with get_db().begin() as conn:
+            rs = complaints.update().where(and_(
+                near_group(complaints.c.content_id, cid),
+                complaints.c.process_status != 'done')).values(values)
+            resolved = conn.execute(rs).rowcount
+            conn.execute(pending.delete().where(pending.c.content_id.in_(sorted(set([cid, key])))))
+
+            if redata['comp'] == 'Bad':
+                rs = contents.update().where(near_group(contents.c.content_id, cid)).\
+                    values(display_status=complaint['complaint_type'])
+                conn.execute(rs)
+
+        if redata['comp'] == 'Bad':
+            rs = select([contents.c.content_id, contents.c.url]).where(near_group(contents.c.content_id, cid))
+            takedowns = [(row[0], row[1]) for row in rs.execute()]
+            members = [member for member, url in takedowns]
+            invalidate(*[content_key(member) for member in members])
+            invalidate_gallery(members)
+            purge_takedowns(takedowns)
+            if len(takedowns) > 1: inf("took down {} near duplicates of content {}".format(len(takedowns) - 1, cid))
+        inf("resolved {} complaints for content {}".format(resolved, cid))
+
+    # delete sqs message, there is none in priority order
+    if redata.get('sqs_handle'):
+        success = delete_sqsmessage(redata['sqs_handle'])
+        if not success: war("sqs message for complaint {} was not deleted".format(redata['complaint_id']))
+
+    return resolved
+
+
+# ------------------------------------------------------------------------------
+def review_message(complaint):
+    """ the sqs message asking for the review of a complaint, as
+        file_complaint sends it
+        in: complaint record
+        return complaint json
+    """
+    keys = ['complaint_timestamp', 'complaint_type', 'process_status', 'display_status',
+            'pinner_id', 'content_id', 'complaint_id']
+    comp = dict((key, complaint[key]) for key in keys)
+    comp['complaint_timestamp'] = str(comp['complaint_timestamp'])
+
+    return comp
+
+
+# ------------------------------------------------------------------------------
+def send_reviews(rows, counters):
+    """ sends the review messages of claimed complaints and marks the
+        claims queued
+        in: complaint records with their review_key, one per claim,
+            progress counters
+    """
+    comps = [review_message(row) for row in rows]
+    sent = {}
+    for row, comp, sqs_id in zip(rows, comps, put_sqsmessages(comps)):
+        if sqs_id in (None, 'error'): counters['errors'] += 1
+        else: sent[row['review_key']] = comp['complaint_id']
+    mark_queued(get_db(), sent)
+    counters['queued'] += len(sent)
+
+
+# ------------------------------------------------------------------------------
+def repair_claim(key, complaint_id, counters=None):
+    """ fixes a claim that points at a complaint which is already done, left
+        when review_complaint resolved the content between file_complaint
+        inserting a complaint and claiming its review. The claim moves to
+        the oldest open complaint under it, with a new message in fifo
+        order, or is deleted when none is open, so later complaints about
+        the content are not only bumped forever.
+        in: content_id the review is claimed under (review_key), the done
+            complaint_id, progress counters
+        out: pending_reviews row, sqs message in fifo order
+        return complaint_id the claim points at now, None if it was deleted
+            or no longer pointed at the done complaint
+    """
+    if counters == None: counters = {'queued': 0, 'errors': 0}
+    complaints = get_table('complaints')
+    pending = get_table('pending_reviews')
+    mine = and_(pending.c.content_id == int(key), pending.c.complaint_id == int(complaint_id))
+
+    rs = complaints.select().where(and_(near_group(complaints.c.content_id, key),
+        complaints.c.process_status == 'complaint')).order_by(complaints.c.complaint_id).limit(1)
+    oldest = first_record(rs.execute())
+    if oldest == None:
+        if pending.delete().where(mine).execute().rowcount == 1:
+            inf("deleted the claim of content {} on done complaint {}".format(key, complaint_id))
+        return None
+
+    rs = pending.update().where(mine).values(complaint_id=oldest['complaint_id'], queued_at=None, leased_until=None)
+    if rs.execute().rowcount != 1: return None
+    war("moved the claim of content {} from done complaint {} to {}".format(key, complaint_id, oldest['complaint_id']))
+
+    if get_review_order() == 'fifo':
+        row = oldest._asdict()
+        row['review_key'] = int(key)
+        send_reviews([row], counters)
+
+    return oldest['complaint_id']
+
+
+# ------------------------------------------------------------------------------
+def claim_stuck(rows, fifo, counters):
+    """ claims the reviews of open complaints that have no claim. The rank
+        counts from the first complaint's time, not now, so the review is
+        not pushed back for having been lost.
+        in: complaint records with their review_key in complaint_id order,
+            fifo review order, progress counters
+        out: pending_reviews rows, sqs messages in fifo order
+    """
+    complaints = get_table('complaints')
+    pending = get_table('pending_reviews')
+    first = collections.OrderedDict()
+    keys = {}
+    for row in rows:
+        if row['review_key'] not in first: first[row['review_key']] = row
+        keys[row['content_id']] = row['review_key']
+
+    rs = select([complaints.c.content_id, func.count()]).where(and_(
+        complaints.c.content_id.in_(sorted(keys)),
+        complaints.c.process_status == 'complaint')).group_by(complaints.c.content_id)
+    counts = collections.Counter()
+    for cid, count in rs.execute(): counts[keys[cid]] += count
+
+    now = datetime.datetime.now()
+    claims = []
+    for key, row in first.items():
+        count = max(counts[key], 1)
+        claims.append({'content_id': key, 'complaint_id': row['complaint_id'], 'claimed_at': now, 'complaints': count,
+                       'review_rank': review_rank(row['complaint_timestamp'].timestamp(), row['complaint_type'], count)})
+
+    with get_db().begin() as conn:
+        conn.execute(insert_ignore(pending), claims)
+        rs = select([pending.c.content_id, pending.c.complaint_id]).where(pending.c.content_id.in_(list(first)))
+        won = [key for key, complaint_id in conn.execute(rs) if complaint_id == first[key]['complaint_id']]
+    counters['claimed'] += len(won)
+
+    if fifo and won: send_reviews([first[key] for key in won], counters)
+
+
+# ------------------------------------------------------------------------------
+def reconcile_claims(cutoff, deadline, cursor, counters):
+    """ finds open complaints older than cutoff whose content has no
+        pending review, e.g. when a container died between filing the
+        complaint and claiming the review, and claims them. Open complaints
+        are read in complaint_id order, reconcile_batch at a time, from the
+        (process_status, complaint_id) index, each joined to its claim by
+        primary key, so a query never reads more than a batch. Complaint
+        ids grow with time, the scan stops at the first complaint newer
+        than cutoff.
+        in: cutoff datetime, deadline epoch, complaint_id to start after,
+            progress counters
+        return complaint_id to resume after, None when the scan finished
+    """
+    complaints = get_table('complaints')
+    pending = get_table('pending_reviews')
+    hashes = get_table('content_hashes')
+    fifo = get_review_order() == 'fifo'
+    key = func.coalesce(hashes.c.group_id, complaints.c.content_id)
+
+    while time.time() < deadline:
+        rs = select([complaints, key.label('review_key'), pending.c.content_id.label('claimed')]).\
+            select_from(complaints.outerjoin(hashes, hashes.c.content_id == complaints.c.content_id).
+                        outerjoin(pending, pending.c.content_id == key)).\
+            where(and_(complaints.c.process_status == 'complaint', complaints.c.complaint_id > (cursor or 0))).\
+            order_by(complaints.c.complaint_id).limit(reconcile_batch)
+        rows = list(iter_records(rs.execute()))
+        counters['scanned'] += len(rows)
+
+        stuck = [row for row in rows if row['claimed'] == None and row['complaint_timestamp'] < cutoff]
+        counters['unclaimed'] += len(stuck)
+        if stuck: claim_stuck(stuck, fifo, counters)
+
+        if len(rows) < reconcile_batch or rows[-1]['complaint_timestamp'] >= cutoff: return None
+        cursor = rows[-1]['complaint_id']
+
+    return cursor
+
+
+# ------------------------------------------------------------------------------
+def repair_claims(deadline, counters):
+    """ finds claims whose complaint is already done and repairs each with
+        repair_claim. review_complaint deletes a claim in the transaction
+        that marks its complaints done, so every such claim is orphaned.
+        Read by content_id from the pending_reviews primary key, each joined
+        to its complaint by primary key, reconcile_batch at a time.
+        in: deadline epoch, progress counters
+        out: pending_reviews rows, sqs messages in fifo order
+    """
+    complaints = get_table('complaints')
+    pending = get_table('pending_reviews')
+
+    cursor = 0
+    while time.time() < deadline:
+        rs = select([pending.c.content_id, pending.c.complaint_id]).\
+            select_from(pending.join(complaints, complaints.c.complaint_id == pending.c.complaint_id)).\
+            where(and_(complaints.c.process_status == 'done', pending.c.content_id > cursor)).\
+            order_by(pending.c.content_id).limit(reconcile_batch)
+        rows = rs.execute().fetchall()
+        if not rows: break
+
+        counters['orphaned'] += len(rows)
+        for key, complaint_id in rows: repair_claim(key, complaint_id, counters)
+        cursor = rows[-1][0]
+
+
+# ------------------------------------------------------------------------------
+def requeue_reviews(cutoff, deadline, counters):
+    """ sends the review message again for claims whose message never went
+        out (queued_at is null and the claim is older than cutoff) or was
+        sent longer ago than the queue keeps messages. Read by content_id
+        from the (queued_at, content_id) index, reconcile_batch at a time.
+        Only for the fifo order, in priority order the claim is the queue
+        entry and pop_review hands out expired leases again.
+        in: cutoff datetime, deadline epoch, progress counters
+        out: sqs messages, pending_reviews.queued_at
+    """
+    complaints = get_table('complaints')
+    pending = get_table('pending_reviews')
+    expired = datetime.datetime.now() - datetime.timedelta(seconds=sqs_retention)
+
+    for name, stale in (('unsent', and_(pending.c.queued_at == None, pending.c.claimed_at < cutoff)),
+                        ('expired', pending.c.queued_at < expired)):
+        cursor = 0
+        while time.time() < deadline:
+            rs = select([complaints, pending.c.content_id.label('review_key')]).\
+                select_from(pending.join(complaints, complaints.c.complaint_id == pending.c.complaint_id)).\
+                where(and_(stale, pending.c.content_id > cursor)).\
+                order_by(pending.c.content_id).limit(reconcile_batch)
+            rows = list(iter_records(rs.execute()))
+            if not rows: break
+
+            counters[name] += len(rows)
+            send_reviews(rows, counters)
+            cursor = rows[-1]['review_key']
+
+
+# ------------------------------------------------------------------------------
+def reconcile_budget(context):
+    """ the time budget of a reconcile run under lambda, what is left of the
+        function's timeout less reconcile_margin, so the run stops before
+        lambda kills it and its cursor is kept for the next run
+        in: lambda context, None outside lambda
+        return seconds, None for the reconcile_seconds default
+    """
+    if context == None or not hasattr(context, 'get_remaining_time_in_millis'): return None
+
+    return max(1, context.get_remaining_time_in_millis() / 1000.0 - reconcile_margin)
+
+
+# ------------------------------------------------------------------------------
+def reconcile(age=None, max_seconds=None, cursor=None):
+    """ reconciles the review queue with the database within a time budget
+        and a memory bound of a batch: repairs claims left on a complaint
+        that is already done, in fifo order sends the messages of claims
+        that were never queued or expired from the queue, and claims open
+        complaints older than age that have no pending review. The
+        scan for unclaimed complaints resumes where the last run in this
+        container ran out of time. The queue is not read: receiving would
+        hide live reviews from the reviewers and count towards a dead
+        letter queue, and fetch_review_item already deletes a message whose
+        complaint is done when it comes up.
+        in: age, seconds before an open complaint counts as stuck
+            (reconcile_age), max_seconds (reconcile_seconds), cursor,
+            complaint_id to start the scan after (default: resume)
+        out: pending_reviews rows, sqs messages sent
+        return progress counters
+    """
+    counters = {'orphaned': 0, 'unsent': 0, 'expired': 0, 'scanned': 0, 'unclaimed': 0, 'claimed': 0, 'queued': 0,
+                'errors': 0}
+    start = time.time()
+    deadline = start + (max_seconds or reconcile_seconds)
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=reconcile_age if age == None else age)
+    fifo = get_review_order() == 'fifo'
+
+    repair_claims(deadline, counters)
+    if fifo: requeue_reviews(cutoff, deadline, counters)
+    if cursor == None: cursor = reconcile_state['cursor']
+    reconcile_state['cursor'] = counters['cursor'] = reconcile_claims(cutoff, deadline, cursor, counters)
+
+    counters['seconds'] = round(time.time() - start, 3)
+    fixed = counters['orphaned'] + counters['claimed'] + counters['queued']
+    if fixed or counters['errors']: war("reconciled {}".format(counters))
+    else: inf("reconciled {}".format(counters))
+
+    return counters
+
+
+# ------------------------------------------------------------------------------
+def reset_content(flagged_only=True, first_id=None, last_id=None, chunk_size=None):
+    """ changes the display_status value to 'good' for content.
+        Essentially is starts the content table fresh. 
+        The complaints are untouched.
+        The reset is a single bulk update, or with chunk_size a series of
+        updates walking the content_id range so no statement runs for long.
+        in: flagged_only, only touch content that is not already 'good'
+            first_id, last_id, optional inclusive content_id range
+            chunk_size, optional number of content_ids per update
+        out: update content records
+        return progress counters
+    """
+    contents = get_table('contents')
+    counters = {'rows': 0, 'chunks': 0, 'seconds': 0.0}
+    start = time.time()
+
+    # filter
+    where = []
+    if flagged_only:
+        where.append(or_(contents.c.display_status != 'good', contents.c.display_status == None))
+    if first_id != None: where.append(contents.c.content_id >= int(first_id))
+    if last_id != None: where.append(contents.c.content_id <= int(last_id))
+
+    def reset(where):
+        # only rows that are not 'good' change, their cache entries are dropped
+        with get_db().begin() as conn:
+            rs = select([contents.c.content_id]).\
+                where(or_(contents.c.display_status != 'good', contents.c.display_status == None))
+            for w in where: rs = rs.where(w)
+            changed = [row[0] for row in conn.execute(rs.with_for_update())]
+
+            rs = contents.update().values(display_status='good')
+            for w in where: rs = rs.where(w)
+            rows = conn.execute(rs).rowcount
+
+        for i in range(0, len(changed), 1000):
+            invalidate(*[content_key(cid) for cid in changed[i:i + 1000]])
+        invalidate_gallery(changed)
+        return rows
+
+    if chunk_size == None:
+        counters['rows'] = reset(where)
+        counters['chunks'] = 1
+    else:
+        # find the primary key range to walk
+        rs = select([func.min(contents.c.content_id), func.max(contents.c.content_id)])
+        for w in where: rs = rs.where(w)
+        low, high = rs.execute().fetchone()
+
+        while low != None and low <= high:
+            chunk = [contents.c.content_id >= low, contents.c.content_id < low + chunk_size]
+            counters['rows'] += reset(where + chunk)
+            counters['chunks'] += 1
+            low += chunk_size
+            inf("reset chunk {chunks}, {rows} rows so far".format(**counters))
+
+    counters['seconds'] = round(time.time() - start, 3)
+    inf("reset {rows} contents in {chunks} chunks, {seconds} s".format(**counters))
+
+    return counters
+
+
+# ------------------------------------------------------------------------------
+if os.environ.get('CS_TRACE', '') not in ('', '0'): set_tracing(True)
+import_timing['total'] = round(time.time() - import_start, 4)
+deb("import timing {}".format(import_timing))
+
+
+# ------------------------------------------------------------------------
+if __name__ == '__main__':
+    """ put module tests and development experiments here
+
+        python -m chalicelib.process stress [threads] [complaints per thread]
+            files complaints about a few contents from many threads against
+            a local queue, never the queue in the secrets, and checks that
+            each content got exactly the review messages it should and ends
+            up with a claim. Point CS_SECRETS at a test database first.
+
+        python -m chalicelib.process records [rows]
+            compares the memory and time of mapping query results to a dict
+            per row, to records, and streaming them, on an in-memory sqlite
+
+        python -m chalicelib.process consume [max records]
+            files the complaints waiting in the ingest queue or write ahead
+            log, see ingest_complaint
+
+        python -m chalicelib.process reconcile [age seconds]
+            requeues stuck complaints and unsent review messages,
+            see reconcile
+
+        python -m chalicelib.process purge content_id ...
+            purges contents from the caches and the cdn by hand, e.g.
+            after a takedown outside the review flow, see purge_takedowns
+    """
+    if sys.argv[1:2] == ['records']:
+        import tracemalloc
+        rows = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        engine = create_engine('sqlite://')
+        bench = Table('complaints', MetaData(engine),
+            Column('complaint_id', Integer, primary_key=True), Column('complaint_timestamp', DateTime),
+            Column('complaint_type', String(80)), Column('process_status', String(20)),
+            Column('display_status', String(20)), Column('review_timestamp', DateTime),
+            Column('pinner_id', Integer), Column('reviewer_id', Integer), Column('content_id', Integer))
+        bench.create()
+        now = datetime.datetime.now()
+        engine.execute(bench.insert(), [{'complaint_timestamp': now, 'complaint_type': 'objectionable',
+            'process_status': 'complaint', 'display_status': 'good', 'pinner_id': i % 50, 'content_id': i % 5000}
+            for i in range(rows)])
+
+        def as_dicts(): return [dict(row) for row in bench.select().execute()]
+        def as_records(): return list(iter_records(bench.select().execute()))
+        def streamed():
+            for record in iter_records(bench.select().execute()): pass
+
+        print("{} rows of complaints".format(rows))
+        print("{:10s} {:>10s} {:>10s} {:>10s}".format('mapping', 'seconds', 'kept MB', 'peak MB'))
+        for name, load in (('dict', as_dicts), ('record', as_records), ('stream', streamed)):
+            # timed without tracing, tracemalloc slows every allocation
+            start = time.time()
+            load()
+            seconds = time.time() - start
+
+            tracemalloc.start()
+            result = load()
+            kept, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("{:10s} {:10.3f} {:10.1f} {:10.1f}".format(name, seconds, kept / 1e6, peak / 1e6))
+            del result
+
+    if sys.argv[1:2] == ['reconcile']:
+        print(reconcile(int(sys.argv[2]) if len(sys.argv) > 2 else None))
+
+    if sys.argv[1:2] == ['purge']:
+        invalidate(*[content_key(cid) for cid in sys.argv[2:]])
+        invalidate_gallery(sys.argv[2:])
+        purge_takedowns([(int(cid), get_content(cid)['url']) for cid in sys.argv[2:]])
+        deadline = time.time() + 10 * purge_interval
+        while any(queue.waiting() for queue in get_purge_queues()) and time.time() < deadline:
+            time.sleep(1)
+            flush_purges(force=True)
+        print(get_purge_stats())
+
+    if sys.argv[1:2] == ['consume']:
+        print(consume_ingest(int(sys.argv[2]) if len(sys.argv) > 2 else 1000))
+
+    if sys.argv[1:2] == ['stress']:
+        from chalicelib.localsqs import LocalSQS
+        threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+        per_thread = int(sys.argv[3]) if len(sys.argv) > 3 else 25
+
+        # the local queue even when the secrets name a real one
+        local = LocalSQS()
+        set_client('sqs', local)
+        queue_url = local.create_queue(QueueName='content_safety_stress')['QueueUrl']
+
+        contents = [c['content_id'] for c in get_content_list(limit=4)]
+        pinner = get_pinners_list(limit=1)[0]['email']
+        pending = get_table('pending_reviews')
+        keys = review_keys(contents)
+        claimed = set(r[0] for r in select([pending.c.content_id]).execute())
+        fifo = get_review_order() == 'fifo'
+        complaints = get_table('complaints')
+        count = select([func.count()]).where(complaints.c.content_id.in_(contents))
+        before = count.scalar()
+
+        # threading.Thread swallows a worker's exception, so failures are kept
+        failures = []
+        def worker():
+            try:
+                for i in range(per_thread):
+                    cid = contents[i % len(contents)]
+                    file_complaint({'display_status': 'good', 'pinner': pinner, 'content_id': cid})
+            except Exception as e:
+                failures.append(repr(e))
+                err("stress worker failed")
+
+        start = time.time()
+        pool = [threading.Thread(target=worker) for n in range(threads)]
+        for t in pool: t.start()
+        for t in pool: t.join()
+        seconds = time.time() - start
+
+        messages = collections.Counter()
+        while True:
+            response = local.receive_message(QueueUrl=get_queue_url(), MaxNumberOfMessages=10, VisibilityTimeout=600)
+            if 'Messages' not in response: break
+            for m in response['Messages']: messages[json.loads(m['Body'])['content_id']] += 1
+
+        filed = count.scalar() - before
+        print("{} of {} complaints filed from {} threads in {:.2f} s".format(
+            filed, threads * per_thread, threads, seconds))
+        expected = dict((cid, 0 if keys[cid] in claimed or not fifo else 1) for cid in contents)
+        for cid in contents:
+            print("content {}: {} messages, expected {}".format(cid, messages[cid], expected[cid]))
+        unclaimed = set(keys.values()) - set(r[0] for r in select([pending.c.content_id]).execute())
+        failed = False
+        if failures:
+            err("{} worker threads failed: {}".format(len(failures), sorted(set(failures))))
+            failed = True
+        if filed != threads * per_thread:
+            err("{} complaints were not filed".format(threads * per_thread - filed))
+            failed = True
+        if any(messages[cid] != expected[cid] for cid in contents):
+            err("review messages lost or duplicated")
+            failed = True
+        if unclaimed:
+            err("contents {} have open complaints and no claim".format(sorted(unclaimed)))
+            failed = True
+        if failed: sys.exit(1)
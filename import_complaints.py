@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+    import_complaints.py
+
+    Import complaints from a file, for backfills and trust and safety partner
+    feeds. The file is csv with a header row or ndjson (one json object per
+    line), with content_id and pinner (email) columns and optionally
+    report_id (the partner's id of the report), display_status,
+    complaint_type and complaint_timestamp. Rows filed before, from this
+    file or another, are counted as known and not filed again. Open complaints
+    are queued for review like complaints from the cs_submit page, one
+    message per content.
+
+    python import_complaints.py feed.csv
+    python import_complaints.py feed.ndjson --chunk 1000
+"""
+
+__copyright__ = '(c) Martin Boliek, All Rights Reserved'
+__author__ = 'Martin Boliek'
+__author_email__ = 'martin@boliek.net'
+__version__ = '0.0.1'
+__date__ = '25 August 2018'
+__modules__ = ''
+
+# standard libraries
+import sys                  # system operations
+import argparse             # command line arguement parsing
+
+# special libraries
+from chalicelib import process
+
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='import complaints from a csv or ndjson file')
+    parser.add_argument('path', help='complaint file')
+    parser.add_argument('--format', choices=['csv', 'ndjson'], help='file format, from the extension if not given')
+    parser.add_argument('--chunk', type=int, default=process.bulk_chunk, help='rows filed per batch')
+    args = parser.parse_args()
+
+    counters = process.file_complaints_bulk(args.path, args.format, args.chunk)
+
+    print("{rows} rows, {filed} filed, {known} known, {rejected} rejected, {dropped} unknown pinners".format(**counters))
+    print("{chunks} chunks in {seconds} s, {rows_per_second} rows/s".format(**counters))
+    if counters['rejected'] or counters['dropped']: sys.exit(1)
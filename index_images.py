@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+    index_images.py
+
+    Index the content images for near duplicate review. Each content that
+    is not in content_hashes yet has its image read from a local copy, the
+    url path under the image directory, hashed in a pool of processes and
+    put in the near duplicate group of the closest indexed image. A
+    complaint about any image of a group then claims the group's review and
+    the reviewer's decision applies to every image in it. Run after new
+    contents are loaded. Needs Pillow.
+
+    python index_images.py /data/images
+    python index_images.py /data/images --workers 8 --distance 4
+"""
+
+__copyright__ = '(c) Martin Boliek, All Rights Reserved'
+__author__ = 'Martin Boliek'
+__author_email__ = 'martin@boliek.net'
+__version__ = '0.0.1'
+__date__ = '25 August 2018'
+__modules__ = ''
+
+# standard libraries
+import argparse             # command line arguement parsing
+
+# special libraries
+from chalicelib import process
+
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='index content images for near duplicate review')
+    parser.add_argument('image_dir', help='directory holding the content images')
+    parser.add_argument('--workers', type=int, help='hashing processes, default one per cpu')
+    parser.add_argument('--distance', type=int, default=process.near_distance,
+                        help='bits of 64 two hashes may differ in and still be one image')
+    parser.add_argument('--chunk', type=int, default=process.bulk_chunk, help='contents indexed per batch')
+    args = parser.parse_args()
+
+    counters = process.index_content_images(args.image_dir, args.workers, args.distance, args.chunk)
+
+    print("{contents} contents, {indexed} indexed, {grouped} near duplicates, {missing} without an image".format(**counters))
+    print("{} s".format(counters['seconds']))
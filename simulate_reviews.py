@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+    simulate_reviews.py
+
+    Simulate a day of complaints and a team of reviewers to compare the
+    review orders: 'fifo', the sqs queue order, and 'priority', the
+    pending_reviews rank from process.review_rank. The measure is time to
+    takedown for heavily reported content, which the reviewers find Bad,
+    and the wait of everything else.
+
+    python simulate_reviews.py
+    python simulate_reviews.py --contents 5000 --heavy 20 --reviewers 4
+"""
+
+__copyright__ = '(c) Martin Boliek, All Rights Reserved'
+__author__ = 'Martin Boliek'
+__author_email__ = 'martin@boliek.net'
+__version__ = '0.0.1'
+__date__ = '25 August 2018'
+__modules__ = ''
+
+# standard libraries
+import heapq                # priority queue
+import random               # complaint arrivals
+import argparse             # command line arguement parsing
+import collections          # deques
+
+# the rank the priority order uses
+from chalicelib import process
+
+
+# ------------------------------------------------------------------------------
+def make_complaints(args):
+    """ Complaint arrivals over the simulated day. Ordinary contents get one
+        to three complaints spread over a few hours, heavy contents get a
+        burst of heavy_complaints within an hour.
+        return time ordered list of (seconds, content_id, complaint_type), heavy content ids
+    """
+    rng = random.Random(args.seed)
+    day = args.hours * 3600
+    complaints = []
+    for cid in range(args.contents):
+        first = rng.uniform(0, day)
+        complaint_type = 'objectionable' if rng.random() < 0.8 else 'copyright'
+        for i in range(rng.randint(1, 3)):
+            complaints.append((first + (rng.uniform(0, 4 * 3600) if i else 0), cid, complaint_type))
+
+    heavy = set(range(args.contents, args.contents + args.heavy))
+    for cid in heavy:
+        first = rng.uniform(0, day / 2)
+        for i in range(args.heavy_complaints):
+            complaints.append((first + (rng.uniform(0, 3600) if i else 0), cid, 'objectionable'))
+
+    complaints.sort()
+    return complaints, heavy
+
+
+# ------------------------------------------------------------------------------
+def simulate(complaints, heavy, order, args):
+    """ Runs the reviewers over the complaints in one review order. A content
+        has one pending review at a time, complaints about a content under
+        review are resolved with it, and heavy content is taken down.
+        return dict content_id -> list of seconds from the first complaint
+            of a review to its decision
+    """
+    pending = {}                    # content_id -> [claimed, type, count, first complaint]
+    fifo = collections.deque()
+    heap = []                       # (rank, content_id, claimed, count), stale entries are skipped
+    in_review = {}                  # content_id -> decision time
+    taken_down = set()
+    waits = collections.defaultdict(list)
+    free = [0.0] * args.reviewers
+    arrivals = collections.deque(complaints)
+
+    def arrive(t, cid, complaint_type):
+        if cid in taken_down or in_review.get(cid, 0) > t: return
+        if cid not in pending:
+            pending[cid] = [t, complaint_type, 1, t]
+            if order == 'fifo': fifo.append(cid)
+        else:
+            pending[cid][2] += 1
+        if order == 'priority':
+            claimed, complaint_type, count, first = pending[cid]
+            heapq.heappush(heap, (process.review_rank(claimed, complaint_type, count), cid, claimed, count))
+
+    def pop():
+        if order == 'fifo':
+            return fifo.popleft() if fifo else None
+        while heap:
+            rank, cid, claimed, count = heapq.heappop(heap)
+            if cid in pending and pending[cid][0] == claimed and pending[cid][2] == count: return cid
+        return None
+
+    while True:
+        now = heapq.heappop(free)
+        while arrivals and arrivals[0][0] <= now: arrive(*arrivals.popleft())
+
+        cid = pop()
+        if cid == None:
+            if not arrivals: break
+            heapq.heappush(free, arrivals[0][0])
+            continue
+
+        decided = now + args.review_seconds
+        waits[cid].append(decided - pending.pop(cid)[3])
+        in_review[cid] = decided
+        if cid in heavy: taken_down.add(cid)
+        heapq.heappush(free, decided)
+
+    return waits
+
+
+# ------------------------------------------------------------------------------
+def percentile(values, q):
+    """ nearest rank percentile of a list, in minutes
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] / 60 if values else 0.0
+
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare the fifo and priority review orders')
+    parser.add_argument('--contents', type=int, default=3000, help='ordinary contents complained about')
+    parser.add_argument('--heavy', type=int, default=10, help='heavily reported contents')
+    parser.add_argument('--heavy-complaints', type=int, default=2000, help='complaints per heavy content')
+    parser.add_argument('--reviewers', type=int, default=3, help='reviewers working the queue')
+    parser.add_argument('--review-seconds', type=float, default=120, help='seconds per review')
+    parser.add_argument('--hours', type=float, default=24, help='hours of complaints')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    complaints, heavy = make_complaints(args)
+    print("{} complaints about {} contents, {} reviewers at {} s a review".format(
+        len(complaints), args.contents + args.heavy, args.reviewers, args.review_seconds))
+    print("{:10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s} {:>8s}".format(
+        'order', 'heavy p50', 'heavy p95', 'heavy max', 'other p50', 'other p95', 'reviews'))
+    for order in ('fifo', 'priority'):
+        waits = simulate(complaints, heavy, order, args)
+        takedown = [waits[cid][0] for cid in heavy]
+        other = [w for cid, ws in waits.items() if cid not in heavy for w in ws]
+        print("{:10s} {:10.1f} {:10.1f} {:10.1f} {:10.1f} {:10.1f} {:8d}".format(
+            order, percentile(takedown, 0.5), percentile(takedown, 0.95), percentile(takedown, 1.0),
+            percentile(other, 0.5), percentile(other, 0.95), len(other) + len(takedown)))
+    print("minutes from the first complaint to the decision")